@@ -0,0 +1,206 @@
+# Benchmarks for the reading, reconstruction and generation hot paths
+# usage:
+#   python benchmarks/run_benchmarks.py [--output <file.json>] [--compare <old.json>] [--quick]
+# results are stored as a json file with one record per benchmark,
+# holding the run time, throughput (frames and pixels per second) and peak memory.
+# with --compare, the results are compared to a previous run
+# and benchmarks that became slower than a given tolerance are reported.
+
+# imports
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+
+# internal modules
+thisdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(thisdir, '../reading'))
+sys.path.append(os.path.join(thisdir, '../reco'))
+sys.path.append(os.path.join(thisdir, '../datagen'))
+import EVIFile
+import counting
+import datagen
+
+
+def measure( func, nrepeat=3 ):
+    ### measure the run time and peak memory of a function
+    # input arguments:
+    # - func: function without arguments
+    # - nrepeat: number of times to run the function;
+    #   the fastest run is used for the timing.
+    # returns:
+    #   a tuple (time in seconds, peak memory in bytes)
+    times = []
+    for i in range(nrepeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter()-start)
+    # measure memory in a separate run, as tracing slows down execution
+    tracemalloc.start()
+    func()
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (min(times), peak)
+
+def make_record( name, params, runtime, peakmem, nframes, npixels ):
+    ### make a benchmark record with derived throughput numbers
+    return {
+      'name': name,
+      'params': params,
+      'time_s': runtime,
+      'frames_per_s': nframes/runtime if runtime>0 else None,
+      'pixels_per_s': npixels/runtime if runtime>0 else None,
+      'peak_memory_bytes': peakmem
+    }
+
+def random_image( image_size, occupancy, rng ):
+    ### make an image with a given fraction of randomly chosen nonzero pixels
+    return (rng.uniform(size=image_size)<occupancy).astype(np.uint16)
+
+def write_synthetic_evi( filename, nframes, image_size, occupancy, rng ):
+    ### write a synthetic EVI file with random frames
+    # note: the frames are generated and written one by one,
+    #       so arbitrarily large files can be made.
+    frames = ( (random_image(image_size, occupancy, rng)
+                *rng.integers(1, 100, size=image_size)).astype(np.uint16)
+               for i in range(nframes) )
+    EVIFile.write_evi(filename, frames, frameHeaderBytes=64)
+
+def bench_evi_read( nframes_list, image_size=(256,256), occupancy=0.01, quick=False ):
+    ### benchmark reading EVI files of increasing size
+    records = []
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for nframes in nframes_list:
+            filename = os.path.join(tmpdir, 'bench_{}.EVI'.format(nframes))
+            write_synthetic_evi(filename, nframes, image_size, occupancy, rng)
+            npixels = nframes*image_size[0]*image_size[1]
+            params = {'nframes': nframes, 'image_size': list(image_size)}
+            for mode in ['memory', 'memmap']:
+
+                def func():
+                    evi = EVIFile.EVIFile(filename, mode=mode)
+                    # touch all frames to include the actual reading
+                    np.sum(evi.get_data())
+
+                (runtime, peakmem) = measure(func, nrepeat=1 if quick else 3)
+                records.append(make_record('EVIFile.read[{}]'.format(mode), params,
+                                           runtime, peakmem, nframes, npixels))
+    return records
+
+def bench_counting( image_sizes, occupancies, quick=False ):
+    ### benchmark the object counting and reconstruction methods
+    records = []
+    rng = np.random.default_rng(2)
+    methods = ({
+      'count_objects_simple': lambda im: counting.count_objects_simple(im),
+      'count_objects_cluster[label]': lambda im: counting.count_objects_cluster(im, method='label'),
+      'count_objects_cluster[iterative]': lambda im: counting.count_objects_cluster(im, method='iterative'),
+      'reco_objects': lambda im: counting.reco_objects(im),
+      'reco_table': lambda im: counting.reco_table(im)
+    })
+    # the quadratic (or worse) methods are skipped for large numbers of hits
+    maxhits = {'count_objects_simple': 5000, 'count_objects_cluster[iterative]': 1000}
+    for image_size in image_sizes:
+        for occupancy in occupancies:
+            im = random_image(image_size, occupancy, rng)
+            nhits = int(np.count_nonzero(im))
+            params = {'image_size': list(image_size), 'occupancy': occupancy, 'nhits': nhits}
+            for name,method in methods.items():
+                if nhits>maxhits.get(name, nhits): continue
+                (runtime, peakmem) = measure(lambda: method(im), nrepeat=1 if quick else 3)
+                records.append(make_record(name, params, runtime, peakmem,
+                                           1, image_size[0]*image_size[1]))
+    return records
+
+def bench_generation( nimages, image_size=(256,256), quick=False ):
+    ### benchmark the generation of images
+    records = []
+    objects = {'blob': {1:10, 2:5, 10:3}, 'line': {15:4}, 'curve': {(15,0.25):2}}
+    params = {'nimages': nimages, 'image_size': list(image_size)}
+    npixels = nimages*image_size[0]*image_size[1]
+
+    def func():
+        for i in range(nimages): datagen.generate_image(image_size=image_size, objects=objects)
+
+    (runtime, peakmem) = measure(func, nrepeat=1 if quick else 3)
+    records.append(make_record('datagen.generate_image', params, runtime, peakmem, nimages, npixels))
+
+    def func():
+        datagen.generate_images(nimages, image_size=image_size, objects=objects, seed=1)
+
+    (runtime, peakmem) = measure(func, nrepeat=1 if quick else 3)
+    records.append(make_record('datagen.generate_images', params, runtime, peakmem, nimages, npixels))
+    return records
+
+def compare( records, reference, tolerance=0.2 ):
+    ### compare benchmark results to a reference
+    # input arguments:
+    # - records: list of benchmark records
+    # - reference: list of benchmark records of a previous run
+    # - tolerance: relative slowdown above which a benchmark is reported as a regression
+    # returns:
+    #   a list of (name, params, relative change in run time) for the regressions
+    refdict = {(r['name'], json.dumps(r['params'], sort_keys=True)): r for r in reference}
+    regressions = []
+    for record in records:
+        key = (record['name'], json.dumps(record['params'], sort_keys=True))
+        if key not in refdict: continue
+        change = record['time_s']/refdict[key]['time_s']-1
+        if change>tolerance: regressions.append((record['name'], record['params'], change))
+    return regressions
+
+def run_all( quick=False ):
+    ### run all benchmarks
+    records = []
+    if quick:
+        records += bench_evi_read([10, 100], quick=True)
+        records += bench_counting([(256,256)], [0.001, 0.01], quick=True)
+        records += bench_generation(20, quick=True)
+    else:
+        records += bench_evi_read([10, 100, 1000])
+        records += bench_counting([(256,256), (256,1024)], [0.0001, 0.001, 0.01, 0.05])
+        records += bench_generation(200)
+    return records
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Run benchmarks')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='Path to the output json file')
+    parser.add_argument('--compare', default=None,
+                        help='Path to a json file of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative slowdown above which a regression is reported')
+    parser.add_argument('--quick', action='store_true',
+                        help='Run a reduced set of benchmarks')
+    args = parser.parse_args()
+
+    records = run_all(quick=args.quick)
+    for record in records:
+        print('{:<36} {:<70} {:>10.4f} s {:>12.1f} frames/s {:>10.1f} MB'.format(
+              record['name'], json.dumps(record['params']), record['time_s'],
+              record['frames_per_s'], record['peak_memory_bytes']/1e6))
+    result = ({
+      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'python': platform.python_version(),
+      'numpy': np.__version__,
+      'platform': platform.platform(),
+      'records': records
+    })
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print('results written to {}'.format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as f: reference = json.load(f)['records']
+        regressions = compare(records, reference, tolerance=args.tolerance)
+        for (name, params, change) in regressions:
+            print('REGRESSION: {} {}: {:+.1%}'.format(name, json.dumps(params), change))
+        if len(regressions)>0: sys.exit(1)
@@ -0,0 +1,237 @@
+# Apply a trained object counting network to full frames
+# The network (see convnet_count_objects.ipynb) predicts the number of objects
+# in a small tile (32x32 pixels by default); full frames are split into overlapping tiles,
+# the tiles are predicted in batches and the counts are stitched back together.
+
+# imports
+import os
+import sys
+import time
+import numpy as np
+
+# internal modules in other directories
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../reco'))
+import counting
+import clustertable
+
+
+def tile_positions( length, tilesize=32, stride=16 ):
+    ### get the start positions of tiles along one axis
+    # the tiles are placed every stride pixels, starting tilesize-stride pixels
+    # before the start of the frame and continuing until the end of the frame is covered,
+    # so that every pixel is covered by exactly tilesize/stride tiles.
+    # note: mostly for internal use!
+    # returns:
+    #   a 1D numpy array with the start positions (negative for tiles
+    #   extending beyond the start of the frame)
+    if stride<=0 or tilesize%stride!=0:
+        msg = 'ERROR in inference.py / tile_positions:'
+        msg += ' the tile size {} must be a multiple of the stride {}.'.format(tilesize, stride)
+        raise Exception(msg)
+    return np.arange(-(tilesize-stride), length, stride)
+
+def tile_view( frame, tilesize=32, stride=16 ):
+    ### split a frame into overlapping tiles without copying
+    # the frame is padded with zeros, so that every pixel of the frame
+    # is covered by the same number of tiles (see tile_positions);
+    # the tiles are a view on the padded frame.
+    # input arguments:
+    # - frame: 2D numpy array
+    # - tilesize: size of the (square) tiles in pixels
+    # - stride: distance between the start of consecutive tiles;
+    #   must divide the tile size.
+    # returns:
+    #   a tuple (tiles, rowpositions, colpositions) with tiles a read-only view
+    #   of shape (<number of tile rows>, <number of tile columns>, tilesize, tilesize),
+    #   and rowpositions, colpositions 1D numpy arrays with the start positions
+    #   of the tile rows and columns in the frame;
+    #   e.g. tiles[i, j] starts at pixel (rowpositions[i], colpositions[j]).
+    # note: the tiles are only copied when a batch is formed (see iter_tile_batches).
+    rowpositions = tile_positions(frame.shape[0], tilesize=tilesize, stride=stride)
+    colpositions = tile_positions(frame.shape[1], tilesize=tilesize, stride=stride)
+    pad = tilesize-stride
+    padded = np.pad(frame, ((pad, rowpositions[-1]+tilesize-frame.shape[0]),
+                            (pad, colpositions[-1]+tilesize-frame.shape[1])))
+    tiles = np.lib.stride_tricks.sliding_window_view(padded, (tilesize, tilesize))[::stride, ::stride]
+    return (tiles, rowpositions, colpositions)
+
+def iter_tile_batches( frame, tilesize=32, stride=16, batchsize=256, binarize=True ):
+    ### iterate over batches of tiles of a frame
+    # input arguments:
+    # - frame, tilesize, stride: see tile_view
+    # - batchsize: number of tiles per batch
+    # - binarize: convert the pixel values to 0 or 1 (as in the training data)
+    # returns:
+    #   a generator yielding tuples (rows, cols, batch) with rows and cols
+    #   the start positions of the tiles in the batch
+    #   and batch a float32 numpy array of shape (ntiles, tilesize, tilesize, 1).
+    (tiles, rowpositions, colpositions) = tile_view(frame, tilesize=tilesize, stride=stride)
+    (rowinds, colinds) = np.meshgrid(np.arange(len(rowpositions)), np.arange(len(colpositions)),
+                                     indexing='ij')
+    rowinds = rowinds.ravel()
+    colinds = colinds.ravel()
+    for start in range(0, len(rowinds), batchsize):
+        (browinds, bcolinds) = (rowinds[start:start+batchsize], colinds[start:start+batchsize])
+        batch = tiles[browinds, bcolinds]
+        if binarize: batch = (batch!=0)
+        yield (rowpositions[browinds], colpositions[bcolinds],
+               batch.astype(np.float32)[:,:,:,np.newaxis])
+
+def stitch_counts( shape, rows, cols, counts, tilesize=32, stride=16 ):
+    ### combine the predicted counts of overlapping tiles into a count density map
+    # method: every pixel of the frame is covered by the same number of tiles
+    #         ((tilesize/stride)^2, see tile_positions),
+    #         so the frame count is the sum of the tile counts divided by this number.
+    #         the count of each tile (divided by this number) is spread uniformly
+    #         over the pixels of the tile inside the frame,
+    #         so the sum of the map equals this frame count.
+    #         in particular, if the count of each tile is exact, the frame count is exact.
+    # input arguments:
+    # - shape: shape of the frame
+    # - rows, cols: 1D numpy arrays with the start positions of the tiles
+    #   (as returned by iter_tile_batches)
+    # - counts: 1D numpy array with the predicted count of each tile
+    # - tilesize, stride: see tile_view
+    # returns:
+    #   a 2D numpy array with the estimated number of objects per pixel;
+    #   its sum is the estimated number of objects in the frame.
+    # note: the accumulation is done with cumulative sums over the tile corners,
+    #       so the cost does not depend on the tile size.
+    ncover = (tilesize//stride)**2
+    # part of each tile inside the frame
+    (row0, row1) = (np.maximum(rows, 0), np.minimum(rows+tilesize, shape[0]))
+    (col0, col1) = (np.maximum(cols, 0), np.minimum(cols+tilesize, shape[1]))
+    density = np.asarray(counts, dtype=np.float64)/(ncover*(row1-row0)*(col1-col0))
+    total = np.zeros((shape[0]+1, shape[1]+1))
+    for (r, c, sign) in [(row0,col0,1), (row1,col0,-1), (row0,col1,-1), (row1,col1,1)]:
+        np.add.at(total, (r, c), sign*density)
+    return np.cumsum(np.cumsum(total, axis=0), axis=1)[:-1,:-1]
+
+
+class CountPredictor():
+    ### class for batched prediction of object counts in full frames
+    # the model can be one of the following:
+    # - path to an .onnx file (run with onnxruntime on CPU)
+    # - path to a saved keras model, e.g. a .keras or .h5 file or a SavedModel directory
+    #   (run with tensorflow on CPU)
+    # - a loaded keras model or any other object with a predict method
+    # - a function taking a batch of tiles and returning the counts
+    # onnxruntime and tensorflow are only imported when needed.
+    # usage:
+    #   predictor = CountPredictor('counting_model.onnx', batchsize=512)
+    #   (count, density) = predictor.count_frame(frame)
+
+    def __init__(self, model, tilesize=32, stride=16, batchsize=256, binarize=True,
+                 nthreads=None):
+        ### initializer
+        # input arguments:
+        # - model: see above
+        # - tilesize: size of the tiles the model was trained on
+        # - stride, binarize: see iter_tile_batches
+        # - batchsize: number of tiles per prediction call
+        # - nthreads: number of CPU threads for the backend (default: backend default)
+        self.tilesize = tilesize
+        self.stride = stride
+        self.batchsize = batchsize
+        self.binarize = binarize
+        self.backend = None
+        self._predict = self._load(model, nthreads)
+
+    def _load(self, model, nthreads):
+        ### make the prediction function for a given model
+        # note: mostly for internal use!
+        if isinstance(model, str) and model.endswith('.onnx'):
+            try: import onnxruntime
+            except ImportError:
+                msg = 'ERROR in inference.py / CountPredictor:'
+                msg += ' onnxruntime is required for .onnx models.'
+                raise Exception(msg)
+            options = onnxruntime.SessionOptions()
+            if nthreads is not None: options.intra_op_num_threads = nthreads
+            session = onnxruntime.InferenceSession(model, sess_options=options,
+                                                   providers=['CPUExecutionProvider'])
+            inputname = session.get_inputs()[0].name
+            self.backend = 'onnxruntime'
+            return lambda batch: session.run(None, {inputname: batch})[0]
+        if isinstance(model, str):
+            try: import tensorflow as tf
+            except ImportError:
+                msg = 'ERROR in inference.py / CountPredictor:'
+                msg += ' tensorflow is required for keras models.'
+                raise Exception(msg)
+            if nthreads is not None:
+                tf.config.threading.set_intra_op_parallelism_threads(nthreads)
+            tf.config.set_visible_devices([], 'GPU')
+            model = tf.keras.models.load_model(model)
+        if hasattr(model, 'predict_on_batch'):
+            # keras model: avoid the overhead of predict for each batch
+            self.backend = 'keras'
+            return lambda batch: np.asarray(model.predict_on_batch(batch))
+        if hasattr(model, 'predict'):
+            self.backend = 'predict'
+            return lambda batch: np.asarray(model.predict(batch))
+        if callable(model):
+            self.backend = 'function'
+            return model
+        msg = 'ERROR in inference.py / CountPredictor:'
+        msg += ' model of type {} not recognized.'.format(type(model))
+        raise Exception(msg)
+
+    def count_frame( self, frame ):
+        ### estimate the number of objects in a frame
+        # input arguments:
+        # - frame: 2D numpy array
+        # returns:
+        #   a tuple (count, density) with count the estimated number of objects
+        #   and density the count density map (see stitch_counts)
+        rows = []
+        cols = []
+        counts = []
+        for (brows, bcols, batch) in iter_tile_batches(frame, tilesize=self.tilesize,
+                stride=self.stride, batchsize=self.batchsize, binarize=self.binarize):
+            rows.append(brows)
+            cols.append(bcols)
+            counts.append(np.reshape(self._predict(batch), -1))
+        density = stitch_counts(frame.shape, np.concatenate(rows), np.concatenate(cols),
+                                np.concatenate(counts), tilesize=self.tilesize,
+                                stride=self.stride)
+        return (float(np.sum(density)), density)
+
+    def count_frames( self, frames ):
+        ### estimate the number of objects in each frame of a stack
+        # input arguments:
+        # - frames: iterable of 2D numpy arrays, or a 3D numpy array
+        #   of shape (height, width, nframes) (as in EVIFile)
+        # returns:
+        #   a 1D numpy array with the estimated number of objects in each frame
+        if isinstance(frames, np.ndarray) and frames.ndim==3:
+            stack = frames
+            frames = (stack[:,:,i] for i in range(stack.shape[2]))
+        return np.array([self.count_frame(frame)[0] for frame in frames])
+
+
+def compare_with_reco( predictor, frames, types=None ):
+    ### compare the network counts to the cluster reconstruction (counting.reco_table)
+    # input arguments:
+    # - predictor: CountPredictor object
+    # - frames: see CountPredictor.count_frames
+    # - types: list of cluster type names to include in the reconstructed count
+    #   (default: all types); e.g. ['blob'] for a network trained on blob counts
+    # returns:
+    #   a dictionary with the per-frame counts of both methods ('network' and 'reco')
+    #   and their total processing times in seconds ('network_time' and 'reco_time').
+    if isinstance(frames, np.ndarray) and frames.ndim==3:
+        frames = [frames[:,:,i] for i in range(frames.shape[2])]
+    else: frames = list(frames)
+    starttime = time.perf_counter()
+    network = predictor.count_frames(frames)
+    network_time = time.perf_counter()-starttime
+    starttime = time.perf_counter()
+    reco = []
+    for frame in frames:
+        counts = clustertable.type_counts(counting.reco_table(frame))
+        if types is not None: counts = {name: counts[name] for name in types}
+        reco.append(sum(counts.values()))
+    reco_time = time.perf_counter()-starttime
+    return {'network': network, 'reco': np.array(reco),
+            'network_time': network_time, 'reco_time': reco_time}
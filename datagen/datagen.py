@@ -1,10 +1,11 @@
+import os
 import numpy as np
 import importlib
 import objectgen
 importlib.reload(objectgen)
 
 
-def generate_object( shape, *args ):
+def generate_object( shape, *args, rng=None ):
     ### generate a single object (i.e. a few neighbouring pixels set to 1)
     # note: mostly for internal use!
     # input arguments:
@@ -17,24 +18,26 @@ def generate_object( shape, *args ):
     #       i.e. only the shape is generated (not the position);
     #       additional processing should be done to place the object 
     #       somewhere in an image.
+    # - rng: numpy random generator (default: a new unseeded one)
     if shape=='blob':
-        return objectgen.generate_blob( *args )
+        return objectgen.generate_blob( *args, rng=rng )
     elif shape=='line':
-        return objectgen.generate_line( *args )
+        return objectgen.generate_line( *args, rng=rng )
     elif shape=='curve':
-        return objectgen.generate_curve( *args )
+        return objectgen.generate_curve( *args, rng=rng )
     else:
         raise Exception('ERROR in datagen.py / generate_object:'
                         +' shape {} not recognized.'.format(shape))
     
-def generate_position( image_size ):
+def generate_position( image_size, rng=None ):
     ### generate a single random position in an image
     # note: mostly for internal use!
     # input arguments:
     # - image_size: tuple of height and width in pixels
+    # - rng: numpy random generator (default: a new unseeded one)
     # returns:
     #   a tuple of coordinates
-    rng = np.random.default_rng()
+    if rng is None: rng = np.random.default_rng()
     xcoord = int(rng.uniform()*image_size[0])
     ycoord = int(rng.uniform()*image_size[1])
     return (xcoord,ycoord)
@@ -60,16 +63,45 @@ def position_object( obj, position, image_size ):
         newobj.append((newxcoord, newycoord))
     return newobj
     
+def get_object_args( obj_conf ):
+    ### convert a key in an object dict (see generate_image) to a list of arguments
+    # note: mostly for internal use!
+    if isinstance(obj_conf,int): return [obj_conf]
+    elif isinstance(obj_conf,tuple): return list(obj_conf)
+    elif isinstance(obj_conf,list): return obj_conf
+    else:
+        raise Exception('ERROR in generate_image: unsupported key in object dict')
+
+def generate_objects( shape, nobjects, rng, *args ):
+    ### generate many objects of the same shape at once
+    # note: mostly for internal use!
+    # vectorized version of generate_object (see above).
+    # returns:
+    #   a tuple (objinds, xcoords, ycoords) of 1D numpy arrays,
+    #   see objectgen.generate_blobs.
+    if shape=='blob':
+        return objectgen.generate_blobs( *args, nobjects, rng )
+    elif shape=='line':
+        return objectgen.generate_lines( *args, nobjects, rng )
+    elif shape=='curve':
+        return objectgen.generate_curves( *args, nobjects, rng )
+    else:
+        raise Exception('ERROR in datagen.py / generate_objects:'
+                        +' shape {} not recognized.'.format(shape))
+
 def generate_image( image_size=(256,256), 
-                    objects={'blob':{1:1}} ):
+                    objects={'blob':{1:1}}, seed=None ):
     ### generate a single image
     # input arguments:
     # - image_size: tuple of height and width in pixels
     # - objects: a dictionary with the properties of the objects to generate,
     #            e.g. {'blob':{1:2},'line':{4:1}} will result in 
     #            2 instance of a size 1 blob and 1 instance of a size 4 line.
+    # - seed: seed for the random generator (or a numpy random generator),
+    #         for reproducible results.
     # returns:
     #   a numpy array of shape image_size
+    rng = np.random.default_rng(seed)
     im = np.zeros(image_size)
     # loop over object shapes (e.g. 'blob' or 'line')
     for obj_shape in objects.keys():
@@ -78,18 +110,127 @@ def generate_image( image_size=(256,256),
         # loop over different configurations for this shape
         for obj_conf in this_shape_dict.keys():
             nobjects = this_shape_dict[obj_conf]
-            args = None
-            if isinstance(obj_conf,int): args = [obj_conf]
-            elif isinstance(obj_conf,tuple): args = list(obj_conf)
-            elif isinstance(obj_conf,list): args = obj_conf
-            else:
-                raise Exception('ERROR in generate_image: unsupported key in object dict')
+            args = get_object_args(obj_conf)
             for objn in range(nobjects):
                 # get an object shape and position
-                obj = generate_object(obj_shape, *args)
-                obj_pos = generate_position(image_size)
+                obj = generate_object(obj_shape, *args, rng=rng)
+                obj_pos = generate_position(image_size, rng=rng)
                 obj = position_object( obj, obj_pos, image_size )
                 # add the object to the image
                 for coord in obj:
                     im[coord[0],coord[1]] = 1
-    return im
\ No newline at end of file
+    return im
+
+# names of the object shapes, in order of their numeric codes (as stored in the truth)
+SHAPE_NAMES = ['blob', 'line', 'curve']
+SHAPE_CODES = {name: code for code,name in enumerate(SHAPE_NAMES)}
+
+# data type of the object positions returned by generate_images
+# (the shape is stored as its code, see SHAPE_NAMES)
+truth_dtype = np.dtype([
+    ('image', np.int64),
+    ('shape', np.int8),
+    ('row', np.int32),
+    ('col', np.int32)
+])
+
+def generate_images( n, image_size=(256,256),
+                     objects={'blob':{1:1}}, seed=None,
+                     batchsize=1000, outfile=None ):
+    ### generate a batch of images
+    # vectorized version of generate_image (see above) for many images at once.
+    # input arguments:
+    # - n: number of images to generate
+    # - image_size: tuple of height and width in pixels
+    # - objects: a dictionary with the properties of the objects to generate,
+    #            in the same format as for generate_image;
+    #            the number of objects can also be a numpy array of length n,
+    #            specifying the number of objects for each image separately.
+    # - seed: seed for the random generator (or a numpy random generator),
+    #         for reproducible results.
+    # - batchsize: number of images to generate at once
+    #              (limits the size of temporary arrays).
+    #              note: the random draws depend on the batch size,
+    #              so use the same batch size to reproduce a data set.
+    # - outfile: path to a .npy file; if specified, the images are written
+    #            directly to this file batch per batch instead of kept in memory,
+    #            and so are the object records to <outfile>_objects.npy;
+    #            the number of objects per image is written to <outfile>_truth.npz.
+    # returns:
+    #   a tuple (images, truth) with:
+    #   - images: a numpy array of shape (n, height, width) and type uint8
+    #     (a read-only memory map of outfile if specified).
+    #   - truth: a dictionary with the following keys:
+    #     - 'counts': dictionary matching each shape to a numpy array
+    #       with the number of objects of that shape in each image.
+    #     - 'objects': structured numpy array with one record per object
+    #       holding the image index, shape code and position (see truth_dtype),
+    #       sorted by image (a read-only memory map if outfile is specified).
+    rng = np.random.default_rng(seed)
+    if outfile is None: images = np.zeros((n,)+tuple(image_size), dtype=np.uint8)
+    else:
+        images = np.lib.format.open_memmap(outfile, mode='w+', dtype=np.uint8,
+                                           shape=(n,)+tuple(image_size))
+    # parse the object configurations and the number of objects per image
+    confs = []
+    counts = {}
+    for obj_shape in objects.keys():
+        if obj_shape not in SHAPE_CODES:
+            raise Exception('ERROR in datagen.py / generate_images:'
+                            +' shape {} not recognized.'.format(obj_shape))
+        counts[obj_shape] = np.zeros(n, dtype=np.int64)
+        for obj_conf,nobjects in objects[obj_shape].items():
+            nobjects = np.broadcast_to(np.asarray(nobjects, dtype=np.int64), (n,))
+            counts[obj_shape] += nobjects
+            confs.append((obj_shape, get_object_args(obj_conf), nobjects))
+    # the total number of objects is known in advance,
+    # so their records can be written batch per batch as well
+    nobjtotal = int(sum([np.sum(nobjects) for (_, _, nobjects) in confs]))
+    if outfile is None: truths = np.zeros(nobjtotal, dtype=truth_dtype)
+    else:
+        objectsfile = os.path.splitext(outfile)[0]+'_objects.npy'
+        truths = np.lib.format.open_memmap(objectsfile, mode='w+', dtype=truth_dtype,
+                                           shape=(nobjtotal,))
+    nwritten = 0
+    # generate the images batch per batch
+    for start in range(0, n, batchsize):
+        stop = min(start+batchsize, n)
+        batch = images[start:stop]
+        if outfile is not None: batch[:] = 0
+        batchtruths = []
+        for (obj_shape, args, nobjects) in confs:
+            # assign objects to images and draw their positions
+            imageinds = np.repeat(np.arange(stop-start), nobjects[start:stop])
+            nobj = len(imageinds)
+            if nobj==0: continue
+            xpos = (rng.uniform(size=nobj)*image_size[0]).astype(int)
+            ypos = (rng.uniform(size=nobj)*image_size[1]).astype(int)
+            truth = np.zeros(nobj, dtype=truth_dtype)
+            truth['image'] = imageinds+start
+            truth['shape'] = SHAPE_CODES[obj_shape]
+            truth['row'] = xpos
+            truth['col'] = ypos
+            batchtruths.append(truth)
+            # generate the object shapes and place them in the images
+            (objinds, xcoords, ycoords) = generate_objects(obj_shape, nobj, rng, *args)
+            xcoords = xcoords + xpos[objinds]
+            ycoords = ycoords + ypos[objinds]
+            inside = ( (xcoords>=0) & (xcoords<image_size[0])
+                       & (ycoords>=0) & (ycoords<image_size[1]) )
+            batch[imageinds[objinds[inside]], xcoords[inside], ycoords[inside]] = 1
+        if len(batchtruths)==0: continue
+        # sort the objects by image (stable, so the generation order is kept within an image)
+        batchtruths = np.concatenate(batchtruths)
+        batchtruths = batchtruths[np.argsort(batchtruths['image'], kind='stable')]
+        truths[nwritten:nwritten+len(batchtruths)] = batchtruths
+        nwritten += len(batchtruths)
+    if outfile is not None:
+        images.flush()
+        truths.flush()
+        del images, truths
+        truthfile = os.path.splitext(outfile)[0]+'_truth.npz'
+        np.savez(truthfile, **{'counts_'+shape: counts[shape] for shape in counts.keys()})
+        images = np.load(outfile, mmap_mode='r')
+        truths = np.load(objectsfile, mmap_mode='r')
+    truth = {'counts': counts, 'objects': truths}
+    return (images, truth)
@@ -1,34 +1,168 @@
 import numpy as np
 import math
+import functools
 
 
+# number of discrete orientations used for the line and curve templates
+NANGLES = 1024
+# maximum number of templates of each kind kept in memory
+NTEMPLATES = 256
+
+
+def _circle_integral( u, R ):
+    ### antiderivative of sqrt(R^2-u^2), for -R <= u <= R
+    # note: mostly for internal use!
+    u = min(max(u, -R), R)
+    return 0.5*(u*math.sqrt(R*R-u*u) + R*R*math.asin(u/R))
+
 def overlap_circle_square( R, center, size ):
     ### calculate the overlap between a cirlce and a square
     # input arguments:
     # - R: radius of the circle, assumed to be centered on the origin.
-    # - center: tuple of (x,y), center point of the square, 
+    # - center: tuple of (x,y), center point of the square,
     # - size: length of the side of the square.
     # returns: fraction of square area overlapping with circle
-    # todo: find analytical expression
-    # for now: approximate using smaller squares
-    noverlap = 0
-    ndiv = 20
-    for x in np.linspace(center[0]-size/2, center[0]+size/2, num=ndiv):
-        for y in np.linspace(center[1]-size/2, center[1]+size/2, num=ndiv):
-            if np.sqrt(x**2+y**2)<R: noverlap += 1
-    foverlap = noverlap/ndiv**2
+    # method: exact integration of the height of the overlap region
+    #         along the x-axis; the height is piecewise constant
+    #         or equal to (plus or minus) the circle boundary sqrt(R^2-x^2),
+    #         with breakpoints where the circle crosses the square edges.
+    x0 = center[0]-size/2
+    x1 = center[0]+size/2
+    y0 = center[1]-size/2
+    y1 = center[1]+size/2
+    if R<=0: return 0.
+    # find the breakpoints within the overlap of the square and the circle in x
+    xmin = max(x0, -R)
+    xmax = min(x1, R)
+    if xmax<=xmin: return 0.
+    breakpoints = [xmin, xmax]
+    for y in (y0, y1):
+        if abs(y)<R:
+            u = math.sqrt(R*R-y*y)
+            breakpoints += [-u, u]
+    breakpoints = sorted(set([b for b in breakpoints if xmin<=b<=xmax]))
+    # integrate the height of the overlap region over each segment
+    area = 0.
+    for a,b in zip(breakpoints[:-1], breakpoints[1:]):
+        mid = (a+b)/2
+        s = math.sqrt(max(R*R-mid*mid, 0.))
+        top = min(y1, s)
+        bottom = max(y0, -s)
+        if top<=bottom: continue
+        segment = _circle_integral(b, R)-_circle_integral(a, R)
+        area += (segment if y1>=s else y1*(b-a))
+        area -= (-segment if y0<=-s else y0*(b-a))
+    foverlap = area/size**2
     return foverlap
 
-def generate_blob( npixels ):
+@functools.lru_cache(maxsize=NTEMPLATES)
+def blob_template( npixels ):
+    ### get the candidate pixels and their probabilities for a blob of a given size
+    # note: mostly for internal use!
+    # the results are cached, so they are computed only once per size.
+    # input arguments:
+    # - npixels: size of the blob in number of pixels (larger than 2)
+    # returns:
+    #   a tuple (xcoords, ycoords, foverlap) of 1D numpy arrays,
+    #   with the coordinates of the candidate pixels
+    #   and the fraction of each pixel overlapping with the approximating circle.
+    # find radius of approximating circle
+    r = math.sqrt(npixels/math.pi)
+    # find half-size of enclosing rectangle
+    sqs = int(math.ceil(r))
+    (i, j) = np.meshgrid(np.arange(-sqs,sqs), np.arange(-sqs,sqs), indexing='ij')
+    (i, j) = (i.ravel(), j.ravel())
+    foverlap = np.array([overlap_circle_square(r, (x,y), 1) for x,y in zip(i.tolist(),j.tolist())])
+    for arr in (i, j, foverlap): arr.setflags(write=False)
+    return (i, j, foverlap)
+
+def _path_template( xcoords, ycoords ):
+    ### convert paths traced in small steps to a padded table of distinct pixels
+    # note: mostly for internal use!
+    # input arguments:
+    # - xcoords, ycoords: 2D numpy arrays of shape (npaths, nsteps)
+    #   with pixel coordinates along each path
+    # returns:
+    #   a tuple (coords, lengths) with coords a numpy array of shape (npaths, maxlength, 2)
+    #   holding the pixels of each path in order with consecutive duplicates removed,
+    #   padded with the last pixel, and lengths the number of pixels per path.
+    keep = np.ones(xcoords.shape, dtype=bool)
+    keep[:,1:] = (xcoords[:,1:]!=xcoords[:,:-1]) | (ycoords[:,1:]!=ycoords[:,:-1])
+    lengths = keep.sum(axis=1)
+    # move the kept steps to the front of each row (stable, so the order is kept)
+    order = np.argsort(~keep, axis=1, kind='stable')[:,:lengths.max()]
+    # pad each row with its last pixel
+    pos = np.minimum(np.arange(lengths.max())[np.newaxis,:], lengths[:,np.newaxis]-1)
+    order = np.take_along_axis(order, pos, axis=1)
+    coords = np.stack((np.take_along_axis(xcoords, order, axis=1),
+                       np.take_along_axis(ycoords, order, axis=1)), axis=-1)
+    coords.setflags(write=False)
+    lengths.setflags(write=False)
+    return (coords, lengths)
+
+@functools.lru_cache(maxsize=NTEMPLATES)
+def line_template( npixels ):
+    ### get the rasterized straight lines of a given length for all discrete orientations
+    # note: mostly for internal use!
+    # the results are cached, so they are computed only once per length.
+    # input arguments:
+    # - npixels: size of the line in number of pixels
+    # returns:
+    #   a tuple (coords, lengths), see _path_template,
+    #   with one path for each of NANGLES orientations.
+    theta = np.arange(NANGLES)/NANGLES*2*math.pi
+    nsteps = npixels*20
+    t = np.arange(nsteps)/nsteps
+    xcoords = np.round(np.outer(npixels*np.cos(theta), t)).astype(int)
+    ycoords = np.round(np.outer(npixels*np.sin(theta), t)).astype(int)
+    return _path_template(xcoords, ycoords)
+
+@functools.lru_cache(maxsize=NTEMPLATES)
+def curve_template( r, cfrac ):
+    ### get the rasterized circle segments of a given radius and size for all discrete orientations
+    # note: mostly for internal use!
+    # the results are cached, so they are computed only once per radius and size.
+    # input arguments:
+    # - r: radius of curvature in number of pixels
+    # - cfrac: fraction of the full circle covered by the line
+    # returns:
+    #   a tuple (coords, lengths), see _path_template,
+    #   with one path for each of NANGLES starting angles.
+    theta1 = np.arange(NANGLES)/NANGLES*2*math.pi
+    nsteps = r*20
+    t = np.arange(nsteps)/nsteps
+    theta = theta1[:,np.newaxis] + cfrac*2*math.pi*t[np.newaxis,:]
+    xcoords = np.trunc(r*np.cos(theta)).astype(int)
+    ycoords = np.trunc(r*np.sin(theta)).astype(int)
+    return _path_template(xcoords, ycoords)
+
+def _random_angles( nobjects, rng ):
+    ### draw random orientations as indices in the line and curve templates
+    # note: mostly for internal use!
+    return np.minimum((rng.uniform(size=nobjects)*NANGLES).astype(int), NANGLES-1)
+
+def _sample_paths( template, nobjects, rng ):
+    ### draw random paths from a line or curve template
+    # note: mostly for internal use!
+    # returns: see generate_blobs
+    (coords, lengths) = template
+    angles = _random_angles(nobjects, rng)
+    paths = coords[angles]
+    valid = np.arange(coords.shape[1])[np.newaxis,:] < lengths[angles][:,np.newaxis]
+    (objinds, steps) = np.nonzero(valid)
+    return (objinds, paths[objinds,steps,0], paths[objinds,steps,1])
+
+def generate_blob( npixels, rng=None ):
     ### generate arbitrarily sized blobs of approximately circular shape
     # input parameters:
     # - npixels: size of the blob in number of pixels
     #            if npixels is 1: return a single pixel
     #            if npixels is 2: return randomly oriented two-pixel cluster
     #            if npixels is > 2: an approximate circle is generated
-    #            (note that the actual number of pixels is probabilistic 
+    #            (note that the actual number of pixels is probabilistic
     #             and can deviate from npixels in this case)
-    rng = np.random.default_rng()
+    # - rng: numpy random generator (default: a new unseeded one)
+    if rng is None: rng = np.random.default_rng()
     if npixels==1:
         return [(0,0)]
     elif npixels==2:
@@ -38,59 +172,73 @@ def generate_blob( npixels ):
         elif( rn>0.5 and rn<0.75 ): return [(0,0), (1,0)]
         else: return [(0,0), (-1,0)]
     else:
-        res = []
-        # find radius of approximating circle
-        r = math.sqrt(npixels/math.pi)
-        # find half-size of enclosing rectangle
-        sqs = int(math.ceil(r))
-        # loop over candidate pixels
-        for i in range(-sqs,sqs):
-            for j in range(-sqs,sqs):
-                # calculate overlap of pixel with approximating circle
-                foverlap = overlap_circle_square(r, (i,j), 1)
-                # add this pixel with a given probability
-                if rng.uniform()<foverlap: res.append((i,j))
-        return res
-    
-def generate_line( npixels ):
+        # add each candidate pixel with a probability given by
+        # its overlap with the approximating circle
+        (i, j, foverlap) = blob_template(npixels)
+        accept = rng.uniform(size=len(foverlap)) < foverlap
+        return list(zip(i[accept].tolist(), j[accept].tolist()))
+
+def generate_line( npixels, rng=None ):
     ### generate a straight line with random orientation
     # input arguments:
     # - npixels: size of the line in number of pixels
     #            (note that the actual number of pixels can deviate from npixels)
-    rng = np.random.default_rng()
-    # generate random angle
-    theta = rng.uniform()*2*math.pi
-    # calculate ending point of the line
-    xend = npixels*np.cos(theta)
-    yend = npixels*np.sin(theta)
-    # travel along the line and add all pixels
-    res = [(0,0)]
-    nsteps = npixels*20
-    for t in range(nsteps):
-        x = t/nsteps*xend
-        y = t/nsteps*yend
-        xcoord = int(round(x))
-        ycoord = int(round(y))
-        if res[-1]!=(xcoord,ycoord):
-            res.append((xcoord,ycoord))
-    return res
-
-def generate_curve( r, cfrac ):
+    # - rng: numpy random generator (default: a new unseeded one)
+    # note: the orientation is drawn from NANGLES discrete values.
+    if rng is None: rng = np.random.default_rng()
+    (coords, lengths) = line_template(npixels)
+    angle = _random_angles(1, rng)[0]
+    return [tuple(el) for el in coords[angle,:lengths[angle]].tolist()]
+
+def generate_curve( r, cfrac, rng=None ):
     ### generate a curved line
     # input arguments:
     # - r: radius of curvature in number of pixels
     # - cfrac: fraction of the full circle covered by the line
-    rng = np.random.default_rng()
-    # generate random opening angle
-    theta1 = rng.uniform()*2*math.pi
-    theta2 = theta1 + cfrac*2*math.pi
-    # travel along circle segment and add all pixels
-    res = [(int(r*math.cos(theta1)),int(r*math.sin(theta1)))]
-    nsteps = r*20
-    for t in range(nsteps):
-        theta = theta1+t/nsteps*(theta2-theta1)
-        xcoord = int(r*math.cos(theta))
-        ycoord = int(r*math.sin(theta))
-        if res[-1]!=(xcoord,ycoord):
-            res.append((xcoord,ycoord))
-    return res   
\ No newline at end of file
+    # - rng: numpy random generator (default: a new unseeded one)
+    # note: the starting angle is drawn from NANGLES discrete values.
+    if rng is None: rng = np.random.default_rng()
+    (coords, lengths) = curve_template(r, cfrac)
+    angle = _random_angles(1, rng)[0]
+    return [tuple(el) for el in coords[angle,:lengths[angle]].tolist()]
+
+
+def generate_blobs( npixels, nobjects, rng ):
+    ### generate many blobs at once
+    # vectorized version of generate_blob (see above).
+    # input arguments:
+    # - npixels: size of the blobs in number of pixels
+    # - nobjects: number of blobs to generate
+    # - rng: numpy random generator
+    # returns:
+    #   a tuple (objinds, xcoords, ycoords) of 1D numpy arrays,
+    #   with for each generated pixel the index of the object it belongs to
+    #   and its coordinates relative to the object position.
+    if npixels==1:
+        objinds = np.arange(nobjects)
+        return (objinds, np.zeros(nobjects, dtype=int), np.zeros(nobjects, dtype=int))
+    elif npixels==2:
+        # each blob consists of the origin and one randomly chosen neighbour
+        neighbours = np.array([(0,1), (0,-1), (1,0), (-1,0)])
+        choice = neighbours[np.minimum((rng.uniform(size=nobjects)*4).astype(int), 3)]
+        objinds = np.repeat(np.arange(nobjects), 2)
+        xcoords = np.stack((np.zeros(nobjects, dtype=int), choice[:,0]), axis=1).ravel()
+        ycoords = np.stack((np.zeros(nobjects, dtype=int), choice[:,1]), axis=1).ravel()
+        return (objinds, xcoords, ycoords)
+    else:
+        (i, j, foverlap) = blob_template(npixels)
+        accept = rng.uniform(size=(nobjects, len(foverlap))) < foverlap
+        (objinds, candinds) = np.nonzero(accept)
+        return (objinds, i[candinds], j[candinds])
+
+def generate_lines( npixels, nobjects, rng ):
+    ### generate many straight lines at once
+    # vectorized version of generate_line (see above).
+    # input arguments and returns: see generate_blobs.
+    return _sample_paths(line_template(npixels), nobjects, rng)
+
+def generate_curves( r, cfrac, nobjects, rng ):
+    ### generate many curved lines at once
+    # vectorized version of generate_curve (see above).
+    # input arguments and returns: see generate_blobs.
+    return _sample_paths(curve_template(r, cfrac), nobjects, rng)
@@ -0,0 +1,227 @@
+import os
+import json
+import queue
+import threading
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import datagen
+
+
+# name of the index file of a sharded data set
+INDEX_FILE = 'index.json'
+
+
+def _shard_objects( objects, start, stop ):
+    ### select the number of objects for a range of images
+    # note: mostly for internal use!
+    # the number of objects in the objects dictionary (see datagen.generate_images)
+    # can be a single number or an array with one entry per image;
+    # in the latter case, only the entries for images start to stop are kept.
+    res = {}
+    for obj_shape,confs in objects.items():
+        res[obj_shape] = {}
+        for obj_conf,nobjects in confs.items():
+            if np.ndim(nobjects)>0: nobjects = np.asarray(nobjects)[start:stop]
+            res[obj_shape][obj_conf] = nobjects
+    return res
+
+def _write_shard( outfile, n, image_size, objects, seedseq, batchsize ):
+    ### generate the images of one shard and write them to disk
+    # note: mostly for internal use! (runs in the worker processes)
+    rng = np.random.default_rng(seedseq)
+    (images, truth) = datagen.generate_images(n, image_size=image_size, objects=objects,
+                                              seed=rng, batchsize=batchsize, outfile=outfile)
+    del images
+    return n
+
+def write_shards( outdir, n, image_size=(32,32), objects={'blob':{1:1}}, seed=None,
+                  shardsize=100000, nworkers=None, batchsize=1000 ):
+    ### generate a large data set of images as a number of shards on disk
+    # each shard consists of a .npy file with the images (uint8),
+    # an _objects.npy file with the object records
+    # and a _truth.npz file with the number of objects per image (see datagen.generate_images).
+    # an index file (index.json) listing the shards is written last,
+    # so a data set without index file is incomplete.
+    # input arguments:
+    # - outdir: directory to write the shards to
+    # - n: total number of images
+    # - image_size, objects: see datagen.generate_images;
+    #   the number of objects can be an array of length n.
+    # - seed: seed for the random generator; each shard gets an independent
+    #   random stream derived from it, so the result does not depend on nworkers.
+    # - shardsize: number of images per shard
+    # - nworkers: number of worker processes (default: number of cpus)
+    # - batchsize: see datagen.generate_images
+    # returns:
+    #   the index of the data set (see read_index)
+    os.makedirs(outdir, exist_ok=True)
+    nshards = -(-n//shardsize)
+    seedseqs = np.random.SeedSequence(seed).spawn(nshards)
+    shards = []
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        futures = []
+        for i in range(nshards):
+            (start, stop) = (i*shardsize, min((i+1)*shardsize, n))
+            name = 'shard_{:05d}'.format(i)
+            futures.append(pool.submit(_write_shard, os.path.join(outdir, name+'.npy'),
+                                       stop-start, tuple(image_size),
+                                       _shard_objects(objects, start, stop),
+                                       seedseqs[i], batchsize))
+            shards.append({'images': name+'.npy', 'truth': name+'_truth.npz',
+                           'objects': name+'_objects.npy', 'nimages': stop-start})
+        for future in futures: future.result()
+    index = {'nimages': n, 'image_size': list(image_size),
+             'shapes': list(objects.keys()), 'shards': shards}
+    tmpfile = os.path.join(outdir, INDEX_FILE+'.tmp')
+    with open(tmpfile, 'w') as f: json.dump(index, f, indent=2)
+    os.replace(tmpfile, os.path.join(outdir, INDEX_FILE))
+    return index
+
+def read_index( indir ):
+    ### read the index of a sharded data set
+    # returns:
+    #   a dictionary with the total number of images ('nimages'), the image size ('image_size'),
+    #   the generated object shapes ('shapes') and a list of shards ('shards'),
+    #   each with the file names of the images, truth and objects and the number of images.
+    indexfile = os.path.join(indir, INDEX_FILE)
+    if not os.path.exists(indexfile):
+        msg = 'ERROR in shards.py / read_index:'
+        msg += ' no index file found in {} (incomplete data set?).'.format(indir)
+        raise Exception(msg)
+    with open(indexfile, 'r') as f: return json.load(f)
+
+
+class ShardedDataset():
+    ### class for reading a sharded data set (see write_shards) in batches
+    # the shards are opened as memory maps, so only the current batches are in memory.
+    # the images are shuffled across a few shards at a time,
+    # and the batches are prepared in a background thread.
+    # usage:
+    #   data = ShardedDataset('data_s32x32')
+    #   model.fit(data.batches(batchsize=32, epochs=10), epochs=10,
+    #             steps_per_epoch=data.steps(32))
+
+    def __init__(self, indir, label='blob', shards=None):
+        ### initializer
+        # input arguments:
+        # - indir: directory with the shards and index file
+        # - label: object shape (or list of shapes) to count for the labels
+        # - shards: list of shard indices to use (default: all),
+        #   e.g. to split the data set into a training and a testing part.
+        self.indir = indir
+        self.index = read_index(indir)
+        self.labels = [label] if isinstance(label, str) else list(label)
+        if shards is None: shards = range(len(self.index['shards']))
+        self.shards = [self.index['shards'][i] for i in shards]
+        self.image_size = tuple(self.index['image_size'])
+
+    def __len__(self):
+        ### return the number of images
+        return sum([shard['nimages'] for shard in self.shards])
+
+    def steps(self, batchsize):
+        ### return the number of batches per epoch
+        return -(-len(self)//batchsize)
+
+    def _load_shard(self, shard):
+        ### open the images of a shard as a memory map and load its labels
+        # note: mostly for internal use!
+        images = np.load(os.path.join(self.indir, shard['images']), mmap_mode='r')
+        with np.load(os.path.join(self.indir, shard['truth'])) as f:
+            labels = sum([f['counts_'+label] for label in self.labels])
+        return (images, labels)
+
+    def _iter_batches(self, batchsize, shuffle, nmix, rng, dtype):
+        ### iterate over the batches of one epoch
+        # note: mostly for internal use!
+        order = rng.permutation(len(self.shards)) if shuffle else np.arange(len(self.shards))
+        # images left over from the previous group of shards (less than one batch)
+        pending = (np.zeros((0,)+self.image_size+(1,), dtype=dtype), np.zeros(0, dtype=np.float32))
+        # process the shards in groups of nmix and mix the images within a group
+        for start in range(0, len(order), nmix):
+            group = [self._load_shard(self.shards[i]) for i in order[start:start+nmix]]
+            shardinds = np.concatenate([np.full(len(labels), i) for i,(_,labels) in enumerate(group)])
+            imageinds = np.concatenate([np.arange(len(labels)) for (_,labels) in group])
+            if shuffle:
+                perm = rng.permutation(len(shardinds))
+                (shardinds, imageinds) = (shardinds[perm], imageinds[perm])
+            nfirst = batchsize-len(pending[1])
+            for bstart in [0]+list(range(nfirst, len(shardinds), batchsize)):
+                bstop = nfirst if bstart==0 else bstart+batchsize
+                (bshards, binds) = (shardinds[bstart:bstop], imageinds[bstart:bstop])
+                images = np.zeros((len(binds),)+self.image_size+(1,), dtype=dtype)
+                labels = np.zeros(len(binds), dtype=np.float32)
+                for i,(shardimages,shardlabels) in enumerate(group):
+                    mask = (bshards==i)
+                    if not np.any(mask): continue
+                    # read in sorted order for sequential disk access
+                    inds = binds[mask]
+                    sorter = np.argsort(inds)
+                    tmp = np.empty((len(inds),)+self.image_size, dtype=shardimages.dtype)
+                    tmp[sorter] = shardimages[inds[sorter]]
+                    images[mask,:,:,0] = tmp
+                    labels[mask] = shardlabels[inds]
+                if bstart==0:
+                    images = np.concatenate((pending[0], images))
+                    labels = np.concatenate((pending[1], labels))
+                if len(labels)<batchsize:
+                    # incomplete batch: complete it with the next group
+                    pending = (images, labels)
+                    continue
+                pending = (pending[0][:0], pending[1][:0])
+                yield (images, labels)
+            del group
+        if len(pending[1])>0: yield pending
+
+    def batches(self, batchsize=32, epochs=1, shuffle=True, nmix=4, seed=None,
+                prefetch=4, dtype=np.float32):
+        ### iterate over the data set in batches
+        # input arguments:
+        # - batchsize: number of images per batch
+        # - epochs: number of passes over the data set (None for infinite)
+        # - shuffle: shuffle the order of the shards and of the images
+        #   within each group of nmix shards
+        # - nmix: number of shards to mix at a time (more mixing costs more random reads)
+        # - seed: seed for the random generator
+        # - prefetch: number of batches prepared in advance in a background thread
+        # - dtype: data type of the images
+        # returns:
+        #   a generator yielding tuples (images, labels) with images a numpy array
+        #   of shape (batchsize, height, width, 1) and labels a 1D numpy array
+        #   with the number of objects of the label shape(s) in each image.
+        rng = np.random.default_rng(seed)
+        batchqueue = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # put an item in the queue, unless the consumer has stopped
+            while not stop.is_set():
+                try:
+                    batchqueue.put(item, timeout=0.1)
+                    return True
+                except queue.Full: pass
+            return False
+
+        def producer():
+            try:
+                epoch = 0
+                while epochs is None or epoch<epochs:
+                    for batch in self._iter_batches(batchsize, shuffle, nmix, rng, dtype):
+                        if not put(batch): return
+                    epoch += 1
+                put(done)
+            except Exception as e: put(e)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batchqueue.get()
+                if batch is done: break
+                if isinstance(batch, Exception): raise batch
+                yield batch
+        finally:
+            # stop the producer if the consumer stops early
+            stop.set()
+            thread.join()
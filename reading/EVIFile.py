@@ -4,15 +4,19 @@
 # imports
 import os
 import sys
+import time
+import itertools
 import numpy as np
 import matplotlib.pyplot as plt
+import hitlist
 
 class EVIFile():
     ### Class for handling XCounter EVI file format 
     # note: follows the naming convention of the ImageJ Java plugin
     
     # initializations
-    headers = {} # dictionary for EVI headers
+    filename = None # path to the EVI file
+    headers = {} # dictionary for EVI headers (replaced by a new dictionary for each file read)
     data = [] # image data
     width = 0 # width of one image in number of pixels
     height = 0 # height in one image in number of pixels
@@ -28,37 +32,77 @@ class EVIFile():
     frameHeaderBytes = 0 # number of bytes reserved for the header for each frame
     is32bit = False # data format (32-bit or 16-bit unsigned integers)
 
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, mode='memory', dtype=None):
         ### initiate with a filename
+        # see read for the meaning of mode and dtype
         if filename is None: pass
-        else: self.read(filename)
+        else: self.read(filename, mode=mode, dtype=dtype)
 
-    def read(self, filename):
+    def read(self, filename, mode='memory', dtype=None):
         ### read an EVI file
+        # input arguments:
+        # - filename: path to the EVI file
+        # - mode: choose from the following options:
+        #   - 'memory': read all frames into a numpy array in memory.
+        #   - 'memmap': map the file into memory without reading any frames;
+        #     frames are only read from disk when they are indexed.
+        #     in this mode, the data always keeps the data type of the file.
+        #   - 'header': only read the header, e.g. for streaming the frames
+        #     afterwards with iter_frames.
+        # - dtype: data type of the pixel values in 'memory' mode
+        #   (default: unsigned integers with the bit depth of the file,
+        #   so 32-bit values are kept at full precision;
+        #   use e.g. np.float32 for energy calculations).
         
+        if mode not in ['memory', 'memmap', 'header']:
+            msg = 'ERROR in EVIFile.read: mode {} not recognized.'.format(mode)
+            raise Exception(msg)
+
         # check file
         if not os.path.exists(filename):
             msg = 'ERROR in EVIFile.read: file {} does not exist.'.format(filename)
-            print(msg)
-            return
+            raise Exception(msg)
         fileextension = os.path.splitext(filename)[1]
         if fileextension.upper()!='.EVI':
             msg = 'WARNING in EVIFile.read: unexpected file extension {}'.format(fileextension)
             print(msg)
-        try: fp = open(filename, encoding='latin-1')
-        except:
+        try: fp = open(filename, 'rb')
+        except OSError as e:
             msg = 'ERROR in EVIFile.read: error while trying to open file {}.'.format(filename)
-            print(msg)
-            return
-        
+            raise Exception(msg) from e
+
         # read the headers
-        for i in range(0, 76): 
-            # note: 76 lines of file header, not completely sure how stable this number is
-            line = fp.readline()
-            name, var = line.partition(" ")[::2]
-            self.headers[name.strip()] = var
-            
-        # set some important headers as instance attributes
+        try:
+            self.headers = read_header(fp)
+            self.set_header_attributes()
+        except Exception:
+            fp.close()
+            raise
+        self.filename = filename
+
+        # map the image data
+        if mode=='memmap':
+            fp.close()
+            self.data = self.memmap(filename)
+            return
+        if mode=='header':
+            fp.close()
+            return
+
+        if dtype is None: dtype = self.pixel_dtype().newbyteorder('=')
+        self.data = np.zeros((self.height, self.width, self.nimages),dtype=dtype)
+
+        # read the image data
+        fp.seek(self.sequenceHeaderBytes-self.frameHeaderBytes) # skip file header
+        for i in range(0, self.nimages):
+            fp.seek(self.frameHeaderBytes, os.SEEK_CUR) # skip frame header
+            tmp = np.fromfile(fp,dtype=self.pixel_dtype(),count=self.width*self.height)
+            self.data[:,:,i] = np.reshape(tmp, (self.height, self.width))
+        fp.close()
+
+    def set_header_attributes(self):
+        ### set some important headers as instance attributes
+        # note: mostly for internal use!
         image_type   = self.headers["Image_Type"]
         self.is32bit = (image_type == "Single") or (image_type == "32-bit Real")
         self.width   = int(self.headers["Width"])
@@ -82,19 +126,132 @@ class EVIFile():
         if "Number_of_board_rows" in self.headers:
             self.numberOfRows = int(self.headers["Number_of_board_rows"])
 
-        self.data = np.zeros((self.height, self.width, self.nimages),dtype=np.uint16)
+    @staticmethod
+    def scan(filename):
+        ### read only the header of an EVI file and summarize the data layout
+        # the pixel data is not touched, so this is fast also for large files.
+        # returns:
+        #   a dictionary with the file name and size, the image size, number of frames,
+        #   bit depth and byte order, and whether the file contains all frames
+        #   announced in the header.
+        evi = EVIFile()
+        with open(filename, 'rb') as fp:
+            evi.headers = read_header(fp)
+        evi.set_header_attributes()
+        filesize = os.path.getsize(filename)
+        framebytes = evi.frame_dtype().itemsize
+        nframes_on_disk = max(0, (filesize-evi.sequenceHeaderBytes+evi.frameHeaderBytes)//framebytes)
+        return {
+          'filename': filename,
+          'filesize': filesize,
+          'width': evi.width,
+          'height': evi.height,
+          'nimages': evi.nimages,
+          'nimages_on_disk': nframes_on_disk,
+          'complete': nframes_on_disk>=evi.nimages,
+          'is32bit': evi.is32bit,
+          'intelByteOrder': evi.intelByteOrder,
+          'frameHeaderBytes': evi.frameHeaderBytes,
+          'sequenceHeaderBytes': evi.sequenceHeaderBytes
+        }
 
-        # read the image data
-        fp.seek(0) # go back to the begining of the file
-        fp.read(self.sequenceHeaderBytes-self.frameHeaderBytes) # skip file header
-        for i in range(0, self.nimages):
-            fp.read(self.frameHeaderBytes) # skip frame header
-            if self.is32bit:
-                tmp = np.fromfile(fp,dtype=np.uint32,count=self.width*self.height).astype(np.uint16)
-            else:
-                tmp = np.fromfile(fp,dtype=np.uint16,count=self.width*self.height)
-            self.data[:,:,i] = np.reshape(tmp, (self.height, self.width))
-        fp.close()
+    def pixel_dtype(self):
+        ### return the numpy data type of a single pixel value as stored in the file
+        byteorder = '<' if self.intelByteOrder else '>'
+        return np.dtype(byteorder + ('u4' if self.is32bit else 'u2'))
+
+    def frame_dtype(self):
+        ### return the numpy data type of a single frame including its frame header
+        # the frame header is represented as an opaque void field 'header',
+        # the pixel values as a field 'data' of shape (height, width).
+        return np.dtype([('header', 'V{}'.format(self.frameHeaderBytes)),
+                         ('data', self.pixel_dtype(), (self.height, self.width))])
+
+    def memmap(self, filename):
+        ### map the image data of an EVI file with known headers into memory
+        # note: mostly for internal use!
+        # returns:
+        #   a read-only numpy array view of shape (height, width, nimages);
+        #   indexing a frame reads it from disk without intermediate copies.
+        offset = self.sequenceHeaderBytes-self.frameHeaderBytes
+        frames = np.memmap(filename, dtype=self.frame_dtype(), mode='r',
+                           offset=offset, shape=(self.nimages,))
+        return np.moveaxis(frames['data'], 0, -1)
+
+    def iter_frames(self, start=0, stop=None, step=1, chunk=None,
+                    follow=False, pollinterval=0.5, timeout=10.):
+        ### iterate over the frames in the file without reading the full file into memory
+        # input arguments:
+        # - start, stop, step: frame indices to read (as in range(start, stop, step)).
+        #   if stop is None, it defaults to the number of frames in the header,
+        #   or to no limit at all in follow mode.
+        # - chunk: number of frames to read at once.
+        #   if None, single frames of shape (height, width) are yielded;
+        #   else, batches of shape (height, width, <at most chunk>) are yielded.
+        # - follow: if True, wait for new frames to be appended to the file
+        #   (e.g. while an acquisition is still being written)
+        #   instead of stopping at the current end of the file.
+        # - pollinterval: time in seconds between checks for new data in follow mode.
+        # - timeout: time in seconds without new data after which to stop in follow mode.
+        # note: the frames are read into one preallocated buffer that is reused,
+        #       so the yielded arrays are overwritten in the next iteration;
+        #       make a copy if they need to be kept.
+        # note: the yielded arrays keep the native data type of the file.
+        if self.filename is None:
+            msg = 'ERROR in EVIFile.iter_frames: no file was read.'
+            raise Exception(msg)
+        if stop is None and not follow: stop = self.nimages
+        nbatch = 1 if chunk is None else chunk
+        framedtype = self.frame_dtype()
+        framebytes = framedtype.itemsize
+        offset = self.sequenceHeaderBytes-self.frameHeaderBytes
+        buf = np.empty(nbatch, dtype=framedtype)
+        rawbuf = memoryview(buf.view(np.uint8))
+        index = start
+        with open(self.filename, 'rb') as fp:
+            while stop is None or index<stop:
+                # determine which frames to read in this batch
+                inds = range(index, index+nbatch*step, step)
+                if stop is not None: inds = inds[:len(range(index, stop, step))]
+                # read the frames, in one go if they are contiguous
+                if step==1:
+                    nbytes = self._readinto(fp, offset+inds[0]*framebytes,
+                                            rawbuf[:len(inds)*framebytes],
+                                            follow, pollinterval, timeout)
+                    nread = nbytes//framebytes
+                else:
+                    nread = 0
+                    for i in inds:
+                        nbytes = self._readinto(fp, offset+i*framebytes,
+                                                rawbuf[nread*framebytes:(nread+1)*framebytes],
+                                                follow, pollinterval, timeout)
+                        if nbytes<framebytes: break
+                        nread += 1
+                if nread==0: return
+                if chunk is None: yield buf['data'][0]
+                else: yield np.moveaxis(buf['data'][:nread], 0, -1)
+                if nread<len(inds): return
+                index = inds[-1]+step
+
+    def _readinto(self, fp, position, view, follow, pollinterval, timeout):
+        ### read bytes from a given position in a file into a buffer
+        # note: mostly for internal use!
+        # returns:
+        #   the number of bytes read, which is smaller than the size of the buffer
+        #   only if the end of the file was reached
+        #   (in follow mode: if no new data was appended during timeout seconds).
+        fp.seek(position)
+        nbytes = 0
+        lastprogress = time.time()
+        while nbytes<len(view):
+            n = fp.readinto(view[nbytes:])
+            if n:
+                nbytes += n
+                lastprogress = time.time()
+                continue
+            if not follow or time.time()-lastprogress>timeout: break
+            time.sleep(pollinterval)
+        return nbytes
 
     def print_header(self):
         ### print the full header of the EVI file
@@ -114,6 +271,17 @@ class EVIFile():
         ### return the numpy array of the raw data
         return self.data
 
+    def get_hits(self, chunk=64):
+        ### return the data as a sparse hit list (see hitlist.py)
+        # input arguments:
+        # - chunk: number of frames to read at once when streaming from the file
+        # note: if the file was read, the frames are streamed from the file
+        #       in chunks, so the full dense data is never held in memory.
+        if self.filename is not None:
+            return hitlist.HitList.from_frames(self.iter_frames(chunk=chunk),
+                                               self.height, self.width)
+        return hitlist.HitList.from_dense(self.data)
+
     def get_header(self):
         ### return the header dictionary
         return self.headers
@@ -123,8 +291,148 @@ class EVIFile():
         #print("(H, W, frames) = ", [self.height, self.width, self.nimages])
         return (self.height, self.width, self.nimages)
 
+    def write(self, filename):
+        ### write the data and headers to an EVI file
+        # see write_evi for more information.
+        return write_evi(filename, self.data, headers=self.headers,
+                         is32bit=self.is32bit, intelByteOrder=self.intelByteOrder,
+                         frameHeaderBytes=self.frameHeaderBytes)
+
+
+def read_header(fp, blocksize=4096, maxbytes=1<<20):
+    ### read the header of an EVI file
+    # method: the header is read as bytes, in blocks, until the Offset_To_First_Image
+    #         header is found; all text lines before the image data
+    #         (and before the first null byte of padding) are parsed.
+    #         hence the number of header lines does not need to be known.
+    # input arguments:
+    # - fp: file object opened in binary mode
+    # - blocksize: number of bytes to read at once
+    # - maxbytes: maximum header size to search in
+    # returns:
+    #   a dictionary matching header names to (string) values
+    fp.seek(0)
+    buf = b''
+    offsetkey = b'Offset_To_First_Image '
+    while True:
+        block = fp.read(blocksize)
+        buf += block
+        pos = buf.find(offsetkey)
+        # make sure the full line is read
+        if pos>=0 and buf.find(b'\n', pos)>=0: break
+        if len(block)==0 or len(buf)>maxbytes:
+            msg = 'ERROR in EVIFile.read_header: no header Offset_To_First_Image found.'
+            raise Exception(msg)
+    offset = int(buf[pos+len(offsetkey):buf.find(b'\n', pos)])
+    # the header of the first frame is included in the offset, so exclude it
+    gap = 0
+    gappos = buf.find(b'Gap_between_iamges_in_bytes ')
+    if gappos>=0: gap = int(buf[gappos:buf.find(b'\n', gappos)].split()[1])
+    if len(buf)<offset-gap: buf += fp.read(offset-gap-len(buf))
+    # parse the text lines up to the padding
+    headers = {}
+    for line in buf[:offset-gap].split(b'\0', 1)[0].split(b'\n'):
+        line = line.decode('latin-1').strip()
+        if len(line)==0: continue
+        name, var = line.partition(" ")[::2]
+        headers[name.strip()] = var.strip()
+    return headers
+
+def scan_files(filenames):
+    ### scan the headers of many EVI files, e.g. to make a run catalogue
+    # input arguments:
+    # - filenames: list of file names, or a glob pattern (e.g. 'data/*.EVI')
+    # returns:
+    #   a list of dictionaries (see EVIFile.scan), one per file;
+    #   files that could not be scanned are reported with an 'error' key.
+    if isinstance(filenames, str):
+        import glob
+        filenames = sorted(glob.glob(filenames))
+    res = []
+    for filename in filenames:
+        try: res.append(EVIFile.scan(filename))
+        except Exception as e: res.append({'filename': filename, 'error': str(e)})
+    return res
 
 def EVIRead(filename):
     ### utility function to read the EVI data and header directly
     evi = EVIFile(filename)
-    return evi
\ No newline at end of file
+    return evi
+
+def write_evi(filename, frames, headers=None, is32bit=False, intelByteOrder=True,
+              frameHeaderBytes=0, blockBytes=512):
+    ### write frames to an EVI file
+    # input arguments:
+    # - filename: path to the output file
+    # - frames: 3D numpy array of shape (height, width, nframes)
+    #   (as returned by EVIFile.get_data()), or any iterable of 2D numpy arrays
+    #   (e.g. a generator), in which case the frames are written one by one
+    #   without keeping them in memory.
+    # - headers: dictionary of additional headers to write.
+    #   the headers describing the data layout (image type, size, number of frames,
+    #   endianness, offsets) are always set from the other arguments.
+    # - is32bit: write the pixel values as 32-bit (instead of 16-bit) unsigned integers
+    # - intelByteOrder: write the pixel values in little-endian (instead of big-endian) byte order
+    # - frameHeaderBytes: size of the (zero-filled) gap before each frame
+    # - blockBytes: the file header is padded to a multiple of this number of bytes
+    # returns:
+    #   the number of frames written
+    if isinstance(frames, np.ndarray):
+        if frames.ndim!=3:
+            msg = 'ERROR in EVIFile.write_evi: expected a 3D array, found shape {}.'.format(frames.shape)
+            raise Exception(msg)
+        stack = frames
+        frames = (stack[:,:,i] for i in range(stack.shape[2]))
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        msg = 'ERROR in EVIFile.write_evi: no frames to write.'
+        raise Exception(msg)
+    (height, width) = np.shape(first)
+    # set the headers describing the data layout;
+    # the numbers that are only known later are formatted with a fixed width,
+    # so they can be filled in afterwards without changing the header size.
+    allheaders = {}
+    if headers is not None: allheaders.update(headers)
+    fixedwidth = '{:<20d}'
+    allheaders.update({
+      'Image_Type': 'Single' if is32bit else '16-bit Unsigned',
+      'Width': str(width),
+      'Height': str(height),
+      'Scan_Frame_Count': fixedwidth.format(0),
+      'Gap_between_iamges_in_bytes': str(frameHeaderBytes),
+      'Endianness': 'Little-endian byte order' if intelByteOrder else 'Big-endian byte order',
+      'Offset_To_First_Image': fixedwidth.format(0)
+    })
+    for name,default in [('HV_TC', '1'), ('Tds', 'false'), ('Tds_Truncate_to_015', 'false')]:
+        if name not in allheaders: allheaders[name] = default
+    # pad to the 76 header lines of the XCounter software
+    # (the reader in this module does not need this, but other readers might)
+    nlines = 76
+    for i in range(nlines-len(allheaders)): allheaders['Reserved_{}'.format(i)] = '0'
+    headerlines = ['{} {}'.format(name, value) for name,value in allheaders.items()]
+    headertext = ('\n'.join(headerlines)+'\n').encode('latin-1')
+    headersize = -(-len(headertext)//blockBytes)*blockBytes
+    offset = headersize+frameHeaderBytes
+    # write the frames
+    byteorder = '<' if intelByteOrder else '>'
+    dtype = np.dtype(byteorder + ('u4' if is32bit else 'u2'))
+    gap = b'\0'*frameHeaderBytes
+    nframes = 0
+    with open(filename, 'wb') as fp:
+        fp.write(headertext.ljust(headersize, b'\0'))
+        for frame in itertools.chain([first], frames):
+            if np.shape(frame)!=(height, width):
+                msg = 'ERROR in EVIFile.write_evi: frame {} has shape {}'.format(nframes, np.shape(frame))
+                msg += ' while {} was expected.'.format((height, width))
+                raise Exception(msg)
+            fp.write(gap)
+            fp.write(np.ascontiguousarray(frame, dtype=dtype).tobytes())
+            nframes += 1
+        # fill in the number of frames and the data offset
+        allheaders['Scan_Frame_Count'] = fixedwidth.format(nframes)
+        allheaders['Offset_To_First_Image'] = fixedwidth.format(offset)
+        headerlines = ['{} {}'.format(name, value) for name,value in allheaders.items()]
+        fp.seek(0)
+        fp.write(('\n'.join(headerlines)+'\n').encode('latin-1'))
+    return nframes
\ No newline at end of file
@@ -0,0 +1,119 @@
+# Sparse representation of a stack of frames as a list of hits
+# Useful for low-occupancy data, where memory and processing time
+# should scale with the number of hits rather than the number of pixels.
+
+# imports
+import numpy as np
+
+
+class HitList():
+    ### Class holding the nonzero pixels (hits) of a stack of frames
+    # the hits are stored in CSR-like format:
+    # - rows, cols, values: 1D numpy arrays with one entry per hit,
+    #   sorted by frame and in row-major order within each frame.
+    # - indptr: 1D numpy array of length nframes+1;
+    #   the hits of frame i are at positions indptr[i] to indptr[i+1].
+    __slots__ = ('height', 'width', 'nframes', 'indptr', 'rows', 'cols', 'values')
+
+    def __init__(self, height, width, indptr, rows, cols, values):
+        ### initializer from the arrays described above
+        self.height = height
+        self.width = width
+        self.nframes = len(indptr)-1
+        self.indptr = indptr
+        self.rows = rows
+        self.cols = cols
+        self.values = values
+
+    @classmethod
+    def from_dense(cls, stack, frame_axis=-1):
+        ### make a hit list from a dense stack of frames
+        # input arguments:
+        # - stack: 3D numpy array (e.g. the result of EVIFile.get_data())
+        #   or 2D numpy array (a single frame)
+        # - frame_axis: axis of stack corresponding to the frames
+        #   (default: last axis, as in EVIFile; use 0 for datagen.generate_images)
+        stack = np.asarray(stack)
+        if stack.ndim==2: stack = stack[:,:,np.newaxis]
+        else: stack = np.moveaxis(stack, frame_axis, -1)
+        return cls.from_frames([stack], stack.shape[0], stack.shape[1])
+
+    @classmethod
+    def from_frames(cls, frames, height, width):
+        ### make a hit list from an iterable of frames or frame batches
+        # input arguments:
+        # - frames: iterable of 2D numpy arrays of shape (height, width)
+        #   or 3D numpy arrays of shape (height, width, <number of frames>),
+        #   e.g. the output of EVIFile.iter_frames.
+        #   only the hits are kept, so the frames can be read one batch at a time.
+        # - height, width: size of each frame
+        counts = []
+        rows = []
+        cols = []
+        values = []
+        for batch in frames:
+            if batch.ndim==2: batch = batch[:,:,np.newaxis]
+            # nonzero in (frame, row, column) order
+            batch = np.moveaxis(batch, -1, 0)
+            (f, r, c) = np.nonzero(batch)
+            counts.append(np.bincount(f, minlength=batch.shape[0]))
+            rows.append(r.astype(np.int32))
+            cols.append(c.astype(np.int32))
+            values.append(batch[f, r, c])
+        if len(counts)==0: return cls(height, width, np.zeros(1, dtype=np.int64),
+                                      np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32),
+                                      np.zeros(0, dtype=np.uint16))
+        indptr = np.concatenate(([0], np.cumsum(np.concatenate(counts)))).astype(np.int64)
+        return cls(height, width, indptr, np.concatenate(rows), np.concatenate(cols),
+                   np.concatenate(values))
+
+    def __len__(self):
+        ### return the total number of hits
+        return len(self.rows)
+
+    def nhits(self):
+        ### return the number of hits in each frame
+        return np.diff(self.indptr)
+
+    def occupancy(self):
+        ### return the fraction of nonzero pixels in each frame
+        return self.nhits()/(self.height*self.width)
+
+    def frame_indices(self):
+        ### return the frame index of each hit
+        return np.repeat(np.arange(self.nframes), self.nhits())
+
+    def frame(self, i):
+        ### return the hits of frame i
+        # returns:
+        #   a tuple (rows, cols, values) of 1D numpy arrays (views, not copies)
+        (start, stop) = (self.indptr[i], self.indptr[i+1])
+        return (self.rows[start:stop], self.cols[start:stop], self.values[start:stop])
+
+    def select(self, start, stop):
+        ### return a hit list with the frames from start to stop
+        # returns:
+        #   a new HitList object (the hit arrays are views, not copies)
+        (hstart, hstop) = (self.indptr[start], self.indptr[stop])
+        return HitList(self.height, self.width, self.indptr[start:stop+1]-hstart,
+                       self.rows[hstart:hstop], self.cols[hstart:hstop], self.values[hstart:hstop])
+
+    def to_dense(self, i=None):
+        ### convert to a dense array
+        # input arguments:
+        # - i: index of a single frame to convert (default: all frames)
+        # returns:
+        #   a 2D numpy array of shape (height, width) for a single frame,
+        #   else a 3D numpy array of shape (height, width, nframes).
+        if i is not None:
+            frame = np.zeros((self.height, self.width), dtype=self.values.dtype)
+            (rows, cols, values) = self.frame(i)
+            frame[rows, cols] = values
+            return frame
+        stack = np.zeros((self.height, self.width, self.nframes), dtype=self.values.dtype)
+        stack[self.rows, self.cols, self.frame_indices()] = self.values
+        return stack
+
+    def nbytes(self):
+        ### return the memory used by the hit list in bytes
+        return sum([arr.nbytes for arr in (self.indptr, self.rows, self.cols, self.values)])
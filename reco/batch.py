@@ -0,0 +1,122 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import counting
+import clustertable
+
+
+def _reco_frames( shmname, shape, dtype, start, stop, output='objects' ):
+    ### reconstruct objects in a range of frames stored in shared memory
+    # note: mostly for internal use! (runs in the worker processes)
+    # input arguments:
+    # - shmname: name of the shared memory block holding the frames
+    # - shape: shape of the frame stack, i.e. (nframes, height, width)
+    # - dtype: data type of the frame stack
+    # - start, stop: range of frame indices to process
+    # - output: see BatchReconstructor.reco
+    # returns:
+    #   a list with the result of counting.reco_objects for each frame
+    #   or a cluster table for all frames (depending on output)
+    shm = shared_memory.SharedMemory(name=shmname)
+    try:
+        stack = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        if output=='table':
+            res = clustertable.concatenate([counting.reco_table(stack[i], frame=i)
+                                            for i in range(start, stop)])
+        else: res = [counting.reco_objects(stack[i]) for i in range(start, stop)]
+        del stack
+    finally:
+        shm.close()
+    return res
+
+
+class BatchReconstructor():
+    ### class for reconstructing objects in many frames in parallel
+    # the frames are copied once into a shared memory block
+    # and distributed over a pool of worker processes;
+    # the pool is kept alive between calls to reco,
+    # so it can be reused for many batches.
+    # usage:
+    #   with BatchReconstructor(nworkers=8) as br:
+    #       res = br.reco(evi.get_data())
+
+    def __init__(self, nworkers=None):
+        ### initializer
+        # input arguments:
+        # - nworkers: number of worker processes (default: number of cpus)
+        self.nworkers = nworkers if nworkers is not None else os.cpu_count()
+        self.pool = ProcessPoolExecutor(max_workers=self.nworkers)
+
+    def reco(self, frames, chunksize=None, output='objects'):
+        ### reconstruct objects in a stack of frames
+        # input arguments:
+        # - frames: 3D numpy array of shape (height, width, nframes)
+        #   (e.g. the result of EVIFile.get_data()),
+        #   or a list of 2D numpy arrays of equal shape.
+        # - chunksize: number of frames per task sent to a worker
+        #   (default: spread the frames evenly with a few tasks per worker)
+        # - output: choose from the following options:
+        #   - 'objects': return a list with the result of counting.reco_objects
+        #     for each frame, in order.
+        #   - 'table': return a single cluster table for all frames
+        #     (see clustertable.py), with the frame field set to the frame index.
+        if output not in ['objects', 'table']:
+            msg = 'ERROR in batch.py / BatchReconstructor.reco:'
+            msg += ' output "{}" not recognized.'.format(output)
+            raise Exception(msg)
+        if isinstance(frames, np.ndarray):
+            if frames.ndim!=3:
+                msg = 'ERROR in batch.py / BatchReconstructor.reco:'
+                msg += ' expected a 3D array, found shape {}.'.format(frames.shape)
+                raise Exception(msg)
+            nframes = frames.shape[2]
+            shape = (nframes, frames.shape[0], frames.shape[1])
+            dtype = frames.dtype
+        else:
+            nframes = len(frames)
+            shape = (nframes,) + (np.shape(frames[0]) if nframes>0 else (0,0))
+            dtype = np.asarray(frames[0]).dtype if nframes>0 else np.uint16
+        if np.prod(shape)==0:
+            if output=='table': return clustertable.empty()
+            return [[] for _ in range(nframes)]
+        if chunksize is None: chunksize = max(1, -(-nframes//(4*self.nworkers)))
+        # copy the frames into shared memory
+        nbytes = max(1, int(np.prod(shape))*np.dtype(dtype).itemsize)
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        try:
+            stack = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            if isinstance(frames, np.ndarray): stack[:] = np.moveaxis(frames, -1, 0)
+            else:
+                for i,frame in enumerate(frames): stack[i] = frame
+            del stack
+            # distribute the frames over the workers
+            starts = list(range(0, nframes, chunksize))
+            stops = [min(start+chunksize, nframes) for start in starts]
+            n = len(starts)
+            chunks = self.pool.map(_reco_frames, [shm.name]*n, [shape]*n, [dtype]*n,
+                                   starts, stops, [output]*n)
+            if output=='table': res = clustertable.concatenate(chunks)
+            else: res = [el for chunk in chunks for el in chunk]
+        finally:
+            shm.close()
+            shm.unlink()
+        return res
+
+    def close(self):
+        ### shut down the worker processes
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def reco_objects_batch( frames, nworkers=None, chunksize=None, output='objects' ):
+    ### reconstruct objects in a stack of frames in parallel
+    # convenience function using a temporary BatchReconstructor;
+    # use a BatchReconstructor directly to reuse the worker pool across calls.
+    with BatchReconstructor(nworkers=nworkers) as br:
+        return br.reco(frames, chunksize=chunksize, output=output)
@@ -0,0 +1,65 @@
+import numpy as np
+import reco
+
+
+# data type of a cluster table: one record per reconstructed cluster
+# - frame: index of the frame in which the cluster was found
+# - label: index of the cluster within its frame
+# - row, col: coordinates of the central pixel (see reco.center)
+# - npixels: number of pixels in the cluster
+# - diameter: maximum diameter of the cluster (see reco.max_diameter)
+# - type: type code of the cluster (see reco.TYPE_NAMES)
+# - energy: sum of the pixel values in the cluster
+# - erow, ecol: energy-weighted centroid of the cluster
+# - maxvalue: maximum pixel value in the cluster
+# - angle, length, width, curvature: shape of the cluster (see reco.track_stats)
+cluster_dtype = np.dtype([
+    ('frame', np.int32),
+    ('label', np.int32),
+    ('row', np.int32),
+    ('col', np.int32),
+    ('npixels', np.int32),
+    ('diameter', np.float32),
+    ('type', np.int8),
+    ('energy', np.float64),
+    ('erow', np.float32),
+    ('ecol', np.float32),
+    ('maxvalue', np.float64),
+    ('angle', np.float32),
+    ('length', np.float32),
+    ('width', np.float32),
+    ('curvature', np.float32)
+])
+
+
+def empty( n=0 ):
+    ### make a cluster table with n (zero-initialized) records
+    return np.zeros(n, dtype=cluster_dtype)
+
+def concatenate( tables ):
+    ### concatenate a list of cluster tables (e.g. one per frame) into one table
+    tables = list(tables)
+    if len(tables)==0: return empty()
+    return np.concatenate(tables)
+
+def select_frame( table, frame ):
+    ### get the records of a cluster table belonging to a given frame
+    return table[table['frame']==frame]
+
+def type_counts( table ):
+    ### count the number of clusters of each type
+    # returns:
+    #   a dictionary matching type names to counts
+    counts = np.bincount(table['type'], minlength=len(reco.TYPE_NAMES))
+    return {name: int(counts[code]) for code,name in enumerate(reco.TYPE_NAMES)}
+
+def to_objects( table ):
+    ### convert a cluster table to a list of dictionaries
+    # returns:
+    #   a list of dictionaries of the form {'coords': (<row>, <col>), 'type': <type name>},
+    #   as returned by counting.reco_objects
+    rows = table['row'].tolist()
+    cols = table['col'].tolist()
+    types = table['type'].tolist()
+    return [{'coords': (row, col), 'type': reco.TYPE_NAMES[ctype]}
+            for row,col,ctype in zip(rows, cols, types)]
@@ -1,15 +1,24 @@
 import numpy as np
 import reco
+import labeling
+import clustertable
 
 
-def count_objects_pixels( image ):
+def count_objects_pixels( image, returntype='list' ):
     ### simple object counting method
     # method: count pixels that are nonzero.
     # input arguments:
     # - image: 2D numpy array
+    # - returntype: choose from 'list' or 'array'
     # returns:
-    #   a list of coordinate tuples
+    #   a list of coordinate tuples (if returntype is 'list')
+    #   or a numpy array of shape (npixels, 2) (if returntype is 'array')
     (xcoords,ycoords) = np.nonzero(image)
+    if returntype=='array': return np.stack((xcoords,ycoords), axis=1)
+    elif returntype!='list':
+        msg = 'ERROR in counting.py / count_objects_pixels:'
+        msg += 'returntype "{}" not recognized.'.format(returntype)
+        raise Exception(msg)
     coords = [(xcoord,ycoord) for xcoord,ycoord in zip(xcoords,ycoords)]
     return coords
 
@@ -28,7 +37,7 @@ def count_objects_simple( image ):
         if valid: newcoords.append(coord)
     return newcoords
 
-def count_objects_cluster( image, returntype='center' ):
+def count_objects_cluster( image, returntype='center', method='label' ):
     ### object counting method using proximity clusters
     # method: essentially equal to count_objects_simple,
     #         but more clever way of removing double counting
@@ -42,6 +51,20 @@ def count_objects_cluster( image, returntype='center' ):
     #   see reco.py / center for the definition of the central point.
     # - 'full': return list of lists with tuples of cluster point coordinates.
     #   for each cluster, the full list of points is returned.
+    # the clustering itself depends on the method argument:
+    # - 'label': connected-component labelling in a single pass over the hits,
+    #   see labeling.py. the points within each cluster are in row-major order.
+    # - 'iterative': original implementation that grows each cluster
+    #   by rescanning all unclustered points (slow for busy images).
+    # both methods produce the same clusters, with the same 'first' and 'center' points
+    # (ties in the center are resolved using the growth order of the 'iterative' method);
+    # only the order of the points within each cluster for 'full' differs.
+    if method=='label':
+        return _count_objects_cluster_label( image, returntype=returntype )
+    elif method!='iterative':
+        msg = 'ERROR in counting.py / count_objects_cluster:'
+        msg += 'method "{}" not recognized.'.format(method)
+        raise Exception(msg)
     coords = count_objects_pixels(image)
     clusters = []
     unclustered = [True]*len(coords)
@@ -88,13 +111,113 @@ def count_objects_cluster( image, returntype='center' ):
             raise Exception(msg)
     return res
 
+def _count_objects_cluster_label( image, returntype='center' ):
+    ### implementation of count_objects_cluster with method 'label'
+    # note: mostly for internal use!
+    (rows, cols, labels, nclusters) = labeling.label_image(image)
+    if nclusters==0: return []
+    if returntype=='first':
+        # the first hit of each cluster in row-major order
+        firsts = np.unique(labels, return_index=True)[1]
+        return list(zip(rows[firsts].tolist(), cols[firsts].tolist()))
+    elif returntype=='center':
+        inds = reco.centers(rows, cols, labels, nclusters)
+        return list(zip(rows[inds].tolist(), cols[inds].tolist()))
+    elif returntype=='full':
+        clusters = labeling.split_clusters(rows, cols, labels, nclusters)
+        return [[tuple(point) for point in cluster.tolist()] for cluster in clusters]
+    else:
+        msg = 'ERROR in counting.py / count_objects_cluster:'
+        msg += 'returntype "{}" not recognized.'.format(returntype)
+        raise Exception(msg)
+
 def reco_objects( image ):
     ### extension of count_objects_cluster with determination of cluster type
-    clusters = count_objects_cluster( image, returntype='full' )
-    cinfos = []
-    for cluster in clusters:
-        center = reco.center(cluster)
-        ctype = reco.cluster_type(cluster)
-        cinfo = {'coords': center, 'type': ctype}
-        cinfos.append(cinfo)
-    return cinfos
\ No newline at end of file
+    # returns:
+    #   a list of dictionaries of the form {'coords': (<row>, <col>), 'type': <type name>}
+    # note: see reco_table for a more compact output format.
+    return clustertable.to_objects( reco_table(image) )
+
+def reco_table( image, frame=0, linediameter=reco.LINE_DIAMETER, dotenergy=None ):
+    ### reconstruct the clusters in an image as a cluster table
+    # input arguments:
+    # - image: 2D numpy array
+    # - frame: frame index to store in the table
+    # - linediameter, dotenergy: see reco.cluster_type
+    # returns:
+    #   a structured numpy array with one record per cluster,
+    #   see clustertable.py for the available fields.
+    (rows, cols, labels, nclusters) = labeling.label_image(image)
+    return _make_table(rows, cols, image[rows,cols], labels, nclusters, frame,
+                       linediameter=linediameter, dotenergy=dotenergy)
+
+def reco_hits( hits, linediameter=reco.LINE_DIAMETER, dotenergy=None ):
+    ### reconstruct the clusters in a sparse list of hits as a cluster table
+    # the hits of all frames are labeled in one pass,
+    # so memory and time scale with the number of hits.
+    # input arguments:
+    # - hits: a hit list covering one or more frames (see reading/hitlist.py)
+    # - linediameter, dotenergy: see reco.cluster_type
+    # returns:
+    #   a structured numpy array with one record per cluster,
+    #   see clustertable.py for the available fields.
+    frames = hits.frame_indices()
+    (labels, nclusters) = labeling.label_hits(hits.rows, hits.cols, frames=frames)
+    return _make_table(hits.rows, hits.cols, hits.values, labels, nclusters, frames,
+                       linediameter=linediameter, dotenergy=dotenergy)
+
+def reco_frame_hits( rows, cols, values, frame=0, linediameter=reco.LINE_DIAMETER,
+                     dotenergy=None ):
+    ### reconstruct the clusters in a single frame given as a list of hits
+    # input arguments:
+    # - rows, cols, values: 1D numpy arrays with the coordinates and values of the hits,
+    #   sorted in row-major order (as returned by np.nonzero)
+    # - frame: frame index to store in the table
+    # - linediameter, dotenergy: see reco.cluster_type
+    # returns:
+    #   a structured numpy array with one record per cluster,
+    #   see clustertable.py for the available fields.
+    (labels, nclusters) = labeling.label_hits(rows, cols)
+    return _make_table(rows, cols, values, labels, nclusters, frame,
+                       linediameter=linediameter, dotenergy=dotenergy)
+
+def _make_table( rows, cols, values, labels, nclusters, frames,
+                 linediameter=reco.LINE_DIAMETER, dotenergy=None ):
+    ### make a cluster table from a labeled list of hits
+    # note: mostly for internal use!
+    # input arguments:
+    # - rows, cols, values: 1D numpy arrays with the coordinates and values of the hits
+    # - labels, nclusters: see labeling.label_hits
+    # - frames: frame index of all hits (int) or of each hit (1D numpy array)
+    # - linediameter, dotenergy: see reco.cluster_type
+    table = clustertable.empty(nclusters)
+    if nclusters==0: return table
+    npixels = np.bincount(labels, minlength=nclusters)
+    centerinds = reco.centers(rows, cols, labels, nclusters)
+    diameters = reco.max_diameters(rows, cols, labels, nclusters)
+    if np.ndim(frames)==0:
+        table['frame'] = frames
+        table['label'] = np.arange(nclusters)
+    else:
+        # number the clusters within each frame
+        clusterframes = frames[centerinds]
+        firstlabel = np.searchsorted(clusterframes, clusterframes)
+        table['frame'] = clusterframes
+        table['label'] = np.arange(nclusters)-firstlabel
+    table['row'] = rows[centerinds]
+    table['col'] = cols[centerinds]
+    table['npixels'] = npixels
+    table['diameter'] = diameters
+    (energies, erows, ecols, maxvalues) = reco.energy_stats(rows, cols, values, labels, nclusters)
+    table['type'] = reco.cluster_type_codes(npixels, diameters, linediameter=linediameter,
+                                            energies=energies, dotenergy=dotenergy)
+    table['energy'] = energies
+    table['erow'] = erows
+    table['ecol'] = ecols
+    table['maxvalue'] = maxvalues
+    (angles, lengths, widths, curvatures) = reco.track_stats(rows, cols, labels, nclusters)
+    table['angle'] = angles
+    table['length'] = lengths
+    table['width'] = widths
+    table['curvature'] = curvatures
+    return table
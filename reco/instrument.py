@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import inspect
+import threading
+import importlib
+import numpy as np
+
+# internal modules in other directories
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../reading'))
+
+
+# default stages to instrument: tuples of (category, module, function)
+# where function can be a module-level function or a method (<class>.<method>).
+STAGES = [
+    ('io', 'EVIFile', 'EVIFile.read'),
+    ('io', 'EVIFile', 'EVIFile.iter_frames'),
+    ('io', 'EVIFile', 'EVIFile.get_hits'),
+    ('reco', 'counting', 'reco_table'),
+    ('reco', 'counting', 'reco_hits'),
+    ('reco', 'counting', 'reco_frame_hits'),
+    ('pixels', 'counting', 'count_objects_pixels'),
+    ('labelling', 'labeling', 'label_image'),
+    ('labelling', 'labeling', 'label_hits'),
+    ('geometry', 'reco', 'center'),
+    ('geometry', 'reco', 'centers'),
+    ('geometry', 'reco', 'max_diameter'),
+    ('geometry', 'reco', 'max_diameters'),
+    ('geometry', 'reco', 'energy_stats'),
+    ('geometry', 'reco', 'cluster_type'),
+    ('geometry', 'reco', 'cluster_type_codes'),
+]
+
+
+class Profiler():
+    ### class for measuring where time goes in the reading and reconstruction steps
+    # while active, the stage functions (see STAGES) are replaced by wrappers
+    # recording the wall time of every call; the originals are restored afterwards.
+    # for generator functions (e.g. EVIFile.iter_frames), every produced item
+    # counts as a separate call, so the time spent by the consumer is excluded.
+    # for the labelling stage, the number of hits and clusters per frame
+    # and a histogram of the cluster sizes (in total and per frame) are recorded as well.
+    # note: only calls in the current process are recorded,
+    #       not those in worker processes (e.g. of batch.BatchReconstructor).
+    # usage:
+    #   with Profiler() as prof:
+    #       table = counting.reco_hits(evi.get_hits())
+    #   print(prof.summary())
+    #   prof.to_chrome_trace('trace.json') # open in chrome://tracing or perfetto
+
+    def __init__(self, stages=None):
+        ### initializer
+        # input arguments:
+        # - stages: list of stages to instrument, in the same format as STAGES
+        #   (default: STAGES); stages of modules that cannot be imported are skipped.
+        self.stages = stages if stages is not None else STAGES
+        self.events = []
+        self.framehits = []
+        self.frameclusters = []
+        self.framesizes = []
+        self.clustersizes = np.zeros(0, dtype=np.int64)
+        self._patches = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._t0 = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        ### install the wrappers
+        if self._t0 is None: self._t0 = time.perf_counter()
+        for (category, modname, funcname) in self.stages:
+            try: module = importlib.import_module(modname)
+            except ImportError: continue
+            owner = module
+            parts = funcname.split('.')
+            for part in parts[:-1]: owner = getattr(owner, part)
+            name = parts[-1]
+            original = owner.__dict__[name] if isinstance(owner, type) else getattr(owner, name)
+            label = '{}.{}'.format(modname, funcname)
+            if isinstance(original, (staticmethod, classmethod)):
+                wrapper = type(original)(self._wrap(original.__func__, category, label))
+            else: wrapper = self._wrap(original, category, label)
+            setattr(owner, name, wrapper)
+            self._patches.append((owner, name, original))
+
+    def stop(self):
+        ### restore the original functions
+        for (owner, name, original) in reversed(self._patches): setattr(owner, name, original)
+        self._patches = []
+
+    def _wrap(self, func, category, label):
+        ### make a wrapper recording the calls to func
+        # note: mostly for internal use!
+        profiler = self
+        measure_hits = label.endswith('label_hits')
+        if inspect.isgeneratorfunction(func):
+            # record the time spent producing each item
+            def wrapper(*args, **kwargs):
+                gen = func(*args, **kwargs)
+                while True:
+                    start = profiler._enter()
+                    try: item = next(gen)
+                    except StopIteration:
+                        # the generator is exhausted: no item produced, so no call recorded
+                        profiler._discard()
+                        return
+                    except BaseException:
+                        profiler._exit(category, label, start, {})
+                        raise
+                    profiler._exit(category, label, start, {})
+                    yield item
+        else:
+            def wrapper(*args, **kwargs):
+                start = profiler._enter()
+                info = {}
+                try:
+                    res = func(*args, **kwargs)
+                    if measure_hits: info = profiler._hit_info(args, kwargs, res)
+                finally: profiler._exit(category, label, start, info)
+                return res
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    def _enter(self):
+        ### start timing a call
+        # note: mostly for internal use!
+        stack = getattr(self._local, 'stack', None)
+        if stack is None: stack = self._local.stack = []
+        stack.append(0.)
+        return time.perf_counter()
+
+    def _exit(self, category, label, start, info):
+        ### finish timing a call and store the event
+        # note: mostly for internal use!
+        duration = time.perf_counter()-start
+        stack = self._local.stack
+        childtime = stack.pop()
+        if len(stack)>0: stack[-1] += duration
+        event = {'name': label, 'cat': category, 'start': start-self._t0,
+                 'duration': duration, 'self': duration-childtime,
+                 'thread': threading.get_ident()}
+        event.update(info)
+        with self._lock: self.events.append(event)
+
+    def _discard(self):
+        ### stop timing a call without storing an event
+        # note: mostly for internal use!
+        self._local.stack.pop()
+
+    def _hit_info(self, args, kwargs, res):
+        ### get the number of hits and clusters per frame from a call to labeling.label_hits
+        # note: mostly for internal use!
+        # the cluster sizes per frame are stored as a sparse histogram,
+        # i.e. a list of [size, number of clusters] pairs for each frame.
+        rows = args[0] if len(args)>0 else kwargs['rows']
+        frames = args[2] if len(args)>2 else kwargs.get('frames', None)
+        (labels, nclusters) = res
+        nhits = len(rows)
+        sizes = np.bincount(labels, minlength=nclusters)
+        if frames is None or nhits==0:
+            nframes = 1
+            framehits = [nhits]
+            frameclusters = [nclusters]
+            clusterframes = np.zeros(nclusters, dtype=np.int64)
+        else:
+            frames = np.asarray(frames)
+            nframes = int(frames.max())+1
+            framehits = np.bincount(frames, minlength=nframes).tolist()
+            # frame of each cluster, from its first hit
+            firsthits = np.unique(labels, return_index=True)[1]
+            clusterframes = frames[firsthits]
+            frameclusters = np.bincount(clusterframes, minlength=nframes).tolist()
+        (pairs, paircounts) = np.unique(np.stack((clusterframes, sizes), axis=1).reshape(-1, 2),
+                                        axis=0, return_counts=True)
+        bounds = np.searchsorted(pairs[:,0], np.arange(1, nframes))
+        framesizes = [np.stack((framepairs[:,1], framecounts), axis=1).tolist()
+                      for (framepairs, framecounts) in zip(np.split(pairs, bounds),
+                                                           np.split(paircounts, bounds))]
+        hist = np.bincount(sizes)
+        with self._lock:
+            self.framehits.extend(framehits)
+            self.frameclusters.extend(frameclusters)
+            self.framesizes.extend(framesizes)
+            if len(hist)>len(self.clustersizes):
+                hist[:len(self.clustersizes)] += self.clustersizes
+                self.clustersizes = hist
+            else: self.clustersizes[:len(hist)] += hist
+        return {'nhits': nhits, 'nclusters': nclusters}
+
+    def summary(self):
+        ### summarize the recorded events per stage
+        # returns:
+        #   a dictionary matching stage names to dictionaries with the category,
+        #   number of calls, total time (including nested stages),
+        #   self time (excluding nested stages) and mean and maximum time per call in seconds.
+        res = {}
+        for event in self.events:
+            if event['name'] not in res:
+                res[event['name']] = {'category': event['cat'], 'calls': 0, 'total': 0.,
+                                      'self': 0., 'max': 0.}
+            stage = res[event['name']]
+            stage['calls'] += 1
+            stage['total'] += event['duration']
+            stage['self'] += event['self']
+            stage['max'] = max(stage['max'], event['duration'])
+        for stage in res.values(): stage['mean'] = stage['total']/stage['calls']
+        return res
+
+    def category_summary(self):
+        ### return the total self time per category (e.g. 'io', 'labelling', 'geometry')
+        res = {}
+        for event in self.events: res[event['cat']] = res.get(event['cat'], 0.)+event['self']
+        return res
+
+    def to_dict(self):
+        ### return all recorded information as a json-serializable dictionary
+        return {'stages': self.summary(),
+                'categories': self.category_summary(),
+                'frames': {'nhits': self.framehits, 'nclusters': self.frameclusters,
+                           'clustersizes': self.framesizes},
+                'clustersizes': self.clustersizes.tolist(),
+                'events': self.events}
+
+    def to_json(self, path):
+        ### write all recorded information to a json file
+        with open(path, 'w') as f: json.dump(self.to_dict(), f, indent=2)
+
+    def to_chrome_trace(self, path):
+        ### write the recorded events in the chrome trace event format
+        # the file can be opened in chrome://tracing or https://ui.perfetto.dev
+        pid = os.getpid()
+        trace = []
+        for event in self.events:
+            args = {key: event[key] for key in ('nhits', 'nclusters') if key in event}
+            trace.append({'name': event['name'], 'cat': event['cat'], 'ph': 'X',
+                          'ts': event['start']*1e6, 'dur': event['duration']*1e6,
+                          'pid': pid, 'tid': event['thread'], 'args': args})
+        with open(path, 'w') as f: json.dump({'traceEvents': trace}, f)
@@ -0,0 +1,165 @@
+from collections import deque
+import numpy as np
+
+
+def _neighbour_pairs( keys, rowstride ):
+    ### find all pairs of neighbouring hits
+    # note: mostly for internal use!
+    # input arguments:
+    # - keys: sorted 1D numpy array of linear pixel indices (one per hit)
+    # - rowstride: number of linear indices per row,
+    #   must be at least 2 more than the largest column index
+    #   in order to avoid wrapping around at the edges.
+    # returns:
+    #   a tuple of two 1D numpy arrays with indices of neighbouring hits.
+    # note: only the 4 'backward' neighbours of each hit are looked up
+    #       (left, upper left, upper and upper right);
+    #       the other 4 are covered by symmetry.
+    srcs = []
+    dsts = []
+    for offset in (1, rowstride-1, rowstride, rowstride+1):
+        candidates = keys - offset
+        pos = np.searchsorted(keys, candidates)
+        pos = np.minimum(pos, len(keys)-1)
+        found = (keys[pos]==candidates)
+        srcs.append(np.nonzero(found)[0])
+        dsts.append(pos[found])
+    return (np.concatenate(srcs), np.concatenate(dsts))
+
+def _connected_components( nhits, src, dst ):
+    ### union-find on a list of edges, in array form
+    # note: mostly for internal use!
+    # method: repeatedly hook the root with the larger index onto the root
+    #         with the smaller index for every edge, followed by pointer jumping
+    #         until every hit points directly to its root.
+    # returns:
+    #   a 1D numpy array with for each hit the index of the root hit
+    #   of its component, which is always the smallest hit index in that component.
+    parent = np.arange(nhits)
+    while True:
+        # pointer jumping: make every hit point directly to its root
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent): break
+            parent = grandparent
+        rsrc = parent[src]
+        rdst = parent[dst]
+        unmerged = (rsrc!=rdst)
+        if not np.any(unmerged): break
+        # hooking: attach the larger root to the smaller root
+        lo = np.minimum(rsrc[unmerged], rdst[unmerged])
+        hi = np.maximum(rsrc[unmerged], rdst[unmerged])
+        np.minimum.at(parent, hi, lo)
+    return parent
+
+def label_hits( rows, cols, frames=None ):
+    ### group a list of hits into clusters of touching pixels
+    # method: two hits belong to the same cluster if they are connected
+    #         through a chain of hits that are pairwise 8-connected,
+    #         i.e. with a difference of less than 2 in both coordinates.
+    # input arguments:
+    # - rows, cols: 1D numpy arrays with row and column coordinates of the hits;
+    #   they are assumed to be sorted in row-major order (as returned by np.nonzero)
+    #   and free of duplicates.
+    # - frames: optional 1D numpy array with the frame index of each hit,
+    #   for labelling the hits of many frames at once;
+    #   hits in different frames never belong to the same cluster.
+    #   the hits are assumed to be sorted by frame first.
+    # returns:
+    #   a tuple (labels, nclusters) with labels a 1D numpy array
+    #   with a cluster index for each hit.
+    #   clusters are numbered in order of their first hit.
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    nhits = len(rows)
+    if nhits==0: return (np.zeros(0, dtype=np.int64), 0)
+    # map hits to linear indices with an empty margin column
+    # (and an empty margin row between frames)
+    rowstride = int(cols.max()-cols.min())+2
+    rows = rows-rows.min()
+    if frames is not None:
+        rows = rows + np.asarray(frames, dtype=np.int64)*(int(rows.max())+2)
+    keys = rows*rowstride + (cols-cols.min())
+    (src, dst) = _neighbour_pairs(keys, rowstride)
+    roots = _connected_components(nhits, src, dst)
+    # relabel roots to consecutive cluster indices
+    (_, labels) = np.unique(roots, return_inverse=True)
+    nclusters = int(labels.max())+1
+    return (labels, nclusters)
+
+def growth_passes( rows, cols, labels ):
+    ### get the pass in which each hit is added to its cluster by the iterative method
+    # the iterative clustering (counting.count_objects_cluster with method 'iterative')
+    # starts each cluster from its first hit and then repeatedly scans
+    # the remaining hits in row-major order, adding every hit that touches
+    # the cluster (including hits added earlier in the same scan).
+    # the points of a cluster are hence ordered by pass first and row-major order second.
+    # note: mostly for internal use!
+    # method: the pass of a hit is the minimum over its neighbours of the pass of the neighbour
+    #         (if the neighbour comes first in row-major order) or that pass plus one
+    #         (if the neighbour comes later), i.e. a shortest path from the first hit
+    #         with edges of weight 0 and 1, which is solved with a 0-1 breadth-first search
+    #         in time linear in the number of hits.
+    # input arguments:
+    # - rows, cols, labels: 1D numpy arrays with the coordinates and cluster index of the hits,
+    #   in row-major order within each cluster (e.g. the output of label_image).
+    # returns:
+    #   a 1D numpy array with the pass number of each hit (1 for the first hit of a cluster).
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    nhits = len(rows)
+    if nhits==0: return np.zeros(0, dtype=np.int64)
+    (_, labels) = np.unique(labels, return_inverse=True)
+    # map hits to linear indices, with each cluster in its own band of rows,
+    # so that hits of different clusters are never neighbours
+    rowstride = int(cols.max()-cols.min())+2
+    rowspan = int(rows.max()-rows.min())+2
+    keys = ((rows-rows.min()) + labels*rowspan)*rowstride + (cols-cols.min())
+    order = np.argsort(keys, kind='stable')
+    (later, earlier) = _neighbour_pairs(keys[order], rowstride)
+    (later, earlier) = (order[later], order[earlier])
+    # adjacency lists: weight 0 towards a later neighbour, weight 1 towards an earlier one
+    src = np.concatenate((earlier, later))
+    dst = np.concatenate((later, earlier))
+    weights = np.concatenate((np.zeros(len(later), dtype=np.int64), np.ones(len(earlier), dtype=np.int64)))
+    edgeorder = np.argsort(src, kind='stable')
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(src, minlength=nhits)))).tolist()
+    dst = dst[edgeorder].tolist()
+    weights = weights[edgeorder].tolist()
+    # 0-1 breadth-first search from the first hit of each cluster
+    passes = [nhits+1]*nhits
+    queue = deque()
+    for seed in np.unique(labels, return_index=True)[1].tolist():
+        passes[seed] = 1
+        queue.append(seed)
+    while len(queue)>0:
+        hit = queue.popleft()
+        for i in range(bounds[hit], bounds[hit+1]):
+            neighbour = dst[i]
+            newpass = passes[hit]+weights[i]
+            if newpass<passes[neighbour]:
+                passes[neighbour] = newpass
+                if weights[i]==0: queue.appendleft(neighbour)
+                else: queue.append(neighbour)
+    return np.array(passes, dtype=np.int64)
+
+def label_image( image ):
+    ### group the nonzero pixels in an image into clusters of touching pixels
+    # input arguments:
+    # - image: 2D numpy array
+    # returns:
+    #   a tuple (rows, cols, labels, nclusters),
+    #   see label_hits for the definition of labels and nclusters.
+    (rows, cols) = np.nonzero(image)
+    (labels, nclusters) = label_hits(rows, cols)
+    return (rows, cols, labels, nclusters)
+
+def split_clusters( rows, cols, labels, nclusters ):
+    ### split a labeled list of hits into one coordinate array per cluster
+    # returns:
+    #   a list of 2D numpy arrays of shape (npixels, 2),
+    #   with the hits of each cluster in their original order.
+    order = np.argsort(labels, kind='stable')
+    coords = np.stack((rows[order], cols[order]), axis=1)
+    bounds = np.cumsum(np.bincount(labels, minlength=nclusters))[:-1]
+    return np.split(coords, bounds)
@@ -0,0 +1,134 @@
+import time
+import collections
+import numpy as np
+import reco
+import counting
+
+
+class LiveReconstructor():
+    ### class for reconstructing frames one by one during an acquisition
+    # for each new frame, the hits are optionally cleaned from hot pixels
+    # and clustered, and running statistics are updated.
+    # no frames are kept in memory; only per-pixel hit counts
+    # and the hits of the frames in the rolling window.
+    # the cost of an update scales with the number of hits in the new frame
+    # (when the frame is passed as a list of hits).
+    # usage:
+    #   live = LiveReconstructor(evi.height, evi.width, window=1000, hotthreshold=0.5)
+    #   for frame in evi.iter_frames(follow=True):
+    #       table = live.update(frame)
+    #       print(live.rates())
+
+    def __init__(self, height, width, window=None, hotthreshold=None, minframes=100,
+                 mask=None):
+        ### initializer
+        # input arguments:
+        # - height, width: size of the frames
+        # - window: number of most recent frames used for the rolling hit counts
+        #   (default: all frames since the start)
+        # - hotthreshold: fraction of frames (within the rolling window)
+        #   in which a pixel must be hit to be considered hot;
+        #   hits in hot pixels are removed before clustering.
+        #   (default: no masking)
+        # - minframes: minimum number of frames in the rolling window
+        #   before hot pixels are masked
+        # - mask: 2D boolean numpy array with pixels to mask in every frame,
+        #   e.g. built beforehand with masking.load_or_build_mask
+        self.height = height
+        self.width = width
+        self.window = window
+        self.hotthreshold = hotthreshold
+        self.minframes = minframes
+        self.mask = mask
+        self.nframes = 0
+        self.hitcounts = np.zeros((height, width), dtype=np.int64)
+        self.rollingcounts = np.zeros((height, width), dtype=np.int64)
+        self.recenthits = collections.deque()
+        self.typecounts = np.zeros(len(reco.TYPE_NAMES), dtype=np.int64)
+        self.nhits = 0
+        self.nmasked = 0
+        self.starttime = None
+        self.lasttime = None
+
+    def update(self, frame, timestamp=None):
+        ### process a new frame
+        # input arguments:
+        # - frame: 2D numpy array, or tuple (rows, cols, values) of 1D numpy arrays
+        #   with the hits in row-major order (e.g. from hitlist.HitList.frame)
+        # - timestamp: time of the frame in seconds (default: current time)
+        # returns:
+        #   a cluster table for this frame (see clustertable.py),
+        #   with the frame field set to the number of previously processed frames.
+        if timestamp is None: timestamp = time.time()
+        if self.starttime is None: self.starttime = timestamp
+        self.lasttime = timestamp
+        if isinstance(frame, np.ndarray):
+            (rows, cols) = np.nonzero(frame)
+            values = frame[rows, cols]
+        else: (rows, cols, values) = frame
+        # update the per-pixel hit counts
+        # (a pixel appears at most once per frame, so no accumulation is needed)
+        self.hitcounts[rows, cols] += 1
+        self.rollingcounts[rows, cols] += 1
+        self.recenthits.append((rows, cols))
+        if self.window is not None and len(self.recenthits)>self.window:
+            (oldrows, oldcols) = self.recenthits.popleft()
+            self.rollingcounts[oldrows, oldcols] -= 1
+        if self.window is None: self.recenthits.clear()
+        # remove hits in masked and hot pixels
+        masked = np.zeros(len(rows), dtype=bool)
+        if self.mask is not None: masked |= self.mask[rows, cols]
+        nrolling = self._nrolling()
+        if self.hotthreshold is not None and nrolling>=self.minframes:
+            masked |= self.rollingcounts[rows, cols] > self.hotthreshold*nrolling
+        if np.any(masked):
+            self.nmasked += int(np.count_nonzero(masked))
+            (rows, cols, values) = (rows[~masked], cols[~masked], values[~masked])
+        # reconstruct the clusters and update the running totals
+        table = counting.reco_frame_hits(rows, cols, values, frame=self.nframes)
+        self.typecounts += np.bincount(table['type'], minlength=len(reco.TYPE_NAMES))
+        self.nhits += len(rows)
+        self.nframes += 1
+        return table
+
+    def _nrolling(self):
+        ### return the number of frames in the rolling window (including the current one)
+        # note: mostly for internal use!
+        if self.window is None: return self.nframes+1
+        return min(self.nframes+1, self.window)
+
+    def hot_pixels(self):
+        ### return a 2D boolean array marking the pixels currently considered hot
+        nrolling = min(self.nframes, self.window) if self.window is not None else self.nframes
+        if self.hotthreshold is None or nrolling<self.minframes:
+            return np.zeros((self.height, self.width), dtype=bool)
+        return self.rollingcounts > self.hotthreshold*nrolling
+
+    def occupancy(self, rolling=False):
+        ### return the per-pixel occupancy map
+        # input arguments:
+        # - rolling: if True, use the rolling window instead of all frames
+        # returns:
+        #   a 2D numpy array with the fraction of frames in which each pixel was hit
+        if rolling:
+            nrolling = min(self.nframes, self.window) if self.window is not None else self.nframes
+            return self.rollingcounts/max(nrolling, 1)
+        return self.hitcounts/max(self.nframes, 1)
+
+    def totals(self):
+        ### return the total number of reconstructed clusters per type
+        return {name: int(self.typecounts[code]) for code,name in enumerate(reco.TYPE_NAMES)}
+
+    def rates(self):
+        ### return the average number of clusters per type per frame and per second
+        # returns:
+        #   a dictionary matching type names to tuples (per frame, per second);
+        #   the rate per second is None as long as no time has passed.
+        duration = (self.lasttime-self.starttime) if self.starttime is not None else 0
+        res = {}
+        for code,name in enumerate(reco.TYPE_NAMES):
+            count = int(self.typecounts[code])
+            perframe = count/self.nframes if self.nframes>0 else 0.
+            persecond = count/duration if duration>0 else None
+            res[name] = (perframe, persecond)
+        return res
@@ -0,0 +1,119 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def occupancy_counts( frames, height=None, width=None ):
+    ### count in how many frames each pixel is hit
+    # method: streaming reduction over the frames,
+    #         so only one batch of frames is in memory at a time.
+    # input arguments:
+    # - frames: iterable of 2D numpy arrays of shape (height, width)
+    #   or 3D numpy arrays of shape (height, width, <number of frames>),
+    #   e.g. the output of EVIFile.iter_frames(chunk=...),
+    #   or a single 3D numpy array (e.g. EVIFile.get_data()).
+    # - height, width: size of the frames (only needed if frames is empty)
+    # returns:
+    #   a tuple (counts, nframes) with counts a 2D numpy array
+    if isinstance(frames, np.ndarray): frames = [frames]
+    counts = None
+    nframes = 0
+    for batch in frames:
+        if batch.ndim==2: batch = batch[:,:,np.newaxis]
+        if counts is None: counts = np.zeros(batch.shape[:2], dtype=np.int64)
+        counts += np.count_nonzero(batch, axis=-1)
+        nframes += batch.shape[2]
+    if counts is None: counts = np.zeros((height, width), dtype=np.int64)
+    return (counts, nframes)
+
+def build_mask( frames, threshold=0.1, nsigma=None, height=None, width=None ):
+    ### build a mask of hot (or noisy) pixels from their occupancy in many frames
+    # input arguments:
+    # - frames: see occupancy_counts
+    # - threshold: fraction of frames in which a pixel must be hit to be masked
+    # - nsigma: if specified, a pixel is also masked if its occupancy is more than
+    #   nsigma standard deviations above the mean occupancy of all pixels
+    # - height, width: see occupancy_counts
+    # returns:
+    #   a tuple (mask, occupancy) of 2D numpy arrays,
+    #   with mask True for pixels to be masked
+    #   and occupancy the fraction of frames in which each pixel was hit.
+    (counts, nframes) = occupancy_counts(frames, height=height, width=width)
+    occupancy = counts/max(nframes, 1)
+    mask = occupancy>threshold
+    if nsigma is not None:
+        mask |= occupancy > np.mean(occupancy)+nsigma*np.std(occupancy)
+    return (mask, occupancy)
+
+def apply_mask( frames, mask ):
+    ### remove the hits in masked pixels
+    # input arguments:
+    # - frames: one of the following:
+    #   - 2D numpy array (a single frame)
+    #   - 3D numpy array of shape (height, width, nframes)
+    #   - tuple (rows, cols, values) of 1D numpy arrays with hits
+    #   - hit list (see reading/hitlist.py)
+    # - mask: 2D boolean numpy array, True for pixels to be masked
+    # returns:
+    #   the frames (or hits) in the same format, with the masked hits removed
+    if isinstance(frames, np.ndarray):
+        if frames.ndim==3: return np.where(mask[:,:,np.newaxis], 0, frames).astype(frames.dtype)
+        return np.where(mask, 0, frames).astype(frames.dtype)
+    if isinstance(frames, tuple):
+        (rows, cols, values) = frames
+        keep = ~mask[rows, cols]
+        return (rows[keep], cols[keep], values[keep])
+    # hit list
+    keep = ~mask[frames.rows, frames.cols]
+    nkept = np.bincount(frames.frame_indices()[keep], minlength=frames.nframes)
+    indptr = np.concatenate(([0], np.cumsum(nkept))).astype(np.int64)
+    return type(frames)(frames.height, frames.width, indptr,
+                        frames.rows[keep], frames.cols[keep], frames.values[keep])
+
+def mask_cache_key( evi, threshold, nsigma, detector=None ):
+    ### make a key identifying a mask for a given acquisition or detector
+    # note: mostly for internal use!
+    # input arguments:
+    # - evi: EVIFile object
+    # - threshold, nsigma: see build_mask
+    # - detector: identifier of the detector; if specified, the mask is shared
+    #   between all acquisitions with this detector (and frame size),
+    #   else the mask is specific to the acquisition file (path, size and modification time).
+    key = {'height': evi.height, 'width': evi.width,
+           'threshold': threshold, 'nsigma': nsigma}
+    if detector is not None: key['detector'] = str(detector)
+    else:
+        stat = os.stat(evi.filename)
+        key.update({'file': os.path.abspath(evi.filename),
+                    'size': stat.st_size, 'mtime': stat.st_mtime})
+    keystr = json.dumps(key, sort_keys=True)
+    return hashlib.sha1(keystr.encode('utf-8')).hexdigest()
+
+def load_or_build_mask( evi, cachedir, threshold=0.1, nsigma=None,
+                        detector=None, chunk=64 ):
+    ### get the hot pixel mask for an acquisition, using a cache on disk
+    # if a mask for this acquisition (or detector) and these settings
+    # was built before, it is loaded from the cache directory;
+    # else it is built by streaming over the frames and stored in the cache.
+    # input arguments:
+    # - evi: EVIFile object (opened in any mode)
+    # - cachedir: directory where the masks are stored
+    # - threshold, nsigma: see build_mask
+    # - detector: see mask_cache_key
+    # - chunk: number of frames to read at once when building the mask
+    # returns:
+    #   a tuple (mask, occupancy), see build_mask
+    key = mask_cache_key(evi, threshold, nsigma, detector=detector)
+    cachefile = os.path.join(cachedir, 'mask_{}.npz'.format(key))
+    if os.path.exists(cachefile):
+        with np.load(cachefile) as f:
+            return (f['mask'], f['occupancy'])
+    (mask, occupancy) = build_mask(evi.iter_frames(chunk=chunk), threshold=threshold,
+                                   nsigma=nsigma, height=evi.height, width=evi.width)
+    os.makedirs(cachedir, exist_ok=True)
+    # write to a temporary file first, so an interrupted write does not leave a broken cache
+    tmpfile = cachefile+'.tmp.npz'
+    np.savez_compressed(tmpfile, mask=mask, occupancy=occupancy)
+    os.replace(tmpfile, cachefile)
+    return (mask, occupancy)
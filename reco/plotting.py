@@ -1,6 +1,12 @@
+import os
+import collections
 import numpy as np
 import matplotlib as mpl
+import matplotlib.collections
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+import reco
+import clustertable
 
 def reco_plot(image, figsize=(12,12), cmap='gray',
               objects=None, cdict=None, ldict=None, boxhalfwidth=5):
@@ -15,6 +21,7 @@ def reco_plot(image, figsize=(12,12), cmap='gray',
     #   each dictionary should have the following form:
     #   {'coords': (<row coordinate>, <column coordinate>), 'type': <some type identifier string>}
     #   e.g.: {'coords': (16,25), 'type':'line'}
+    #   alternatively, a cluster table (see clustertable.py) for this image.
     # - cdict: dictionary matching object types to matplotlib colors,
     #   e.g.: {'line': 'blue'}
     # - ldict: dictionary matching object types to labels for the legend,
@@ -28,42 +35,74 @@ def reco_plot(image, figsize=(12,12), cmap='gray',
     # plot the image
     ax.imshow( image, cmap=cmap )
     if objects is None: return (fig,ax)
-    # plot a colored square for each object
-    labels = []
+    # plot colored squares for all objects of the same type at once
+    for (color, label, xcoords, ycoords) in _group_objects(objects, cdict, ldict, 'reco_plot'):
+        ax.add_collection(_box_collection(xcoords, ycoords, boxhalfwidth,
+                                          color=color, label=label))
+    # plot aesthetics
+    ax.legend()
+    # return the result
+    return (fig,ax)
+
+def _group_objects(objects, cdict, ldict, funcname):
+    ### group objects by color and legend label
+    # note: mostly for internal use!
+    # input arguments:
+    # - objects, cdict, ldict: see reco_plot
+    # - funcname: name of the calling function (for error messages)
+    # returns:
+    #   a list of tuples (color, label, xcoords, ycoords),
+    #   one per group in order of first appearance,
+    #   with xcoords and ycoords 1D numpy arrays (column and row coordinates).
+    groups = {}
+    if isinstance(objects, np.ndarray):
+        # cluster table: group by type code without making a dictionary per object
+        for code in np.unique(objects['type']):
+            otype = reco.TYPE_NAMES[code]
+            color = cdict[otype] if cdict is not None else 'r'
+            label = ldict[otype] if ldict is not None else 'Reco'
+            mask = (objects['type']==code)
+            groups.setdefault((color, label), []).append((objects['col'][mask], objects['row'][mask]))
+        return [(color, label, np.concatenate([xcoords for xcoords,_ in coords]),
+                 np.concatenate([ycoords for _,ycoords in coords]))
+                for (color, label), coords in groups.items()]
+    warned = False
     for obj in objects:
         if not isinstance(obj, dict):
-            msg = 'ERROR in plotting.py / reco_plot:'
+            msg = 'ERROR in plotting.py / {}:'.format(funcname)
             msg += ' object is of type {}'.format(type(obj))
             msg += ' while a dict was expected.'
             raise Exception(msg)
         if not 'coords' in obj.keys():
-            msg = 'ERROR in plotting.py / reco_plot:'
+            msg = 'ERROR in plotting.py / {}:'.format(funcname)
             msg += ' object does not contain required key "coords".'
             raise Exception(msg)
-        patchxcoord = obj['coords'][1]
-        patchycoord = obj['coords'][0]
         color = 'r'
         label = 'Reco'
         if 'type' in obj.keys():
             otype = obj['type']
             if cdict is not None: color = cdict[otype]
             if ldict is not None: label = ldict[otype]
-        else:
-            msg = 'WARNING in plotting.py / reco_plot:'
+        elif not warned:
+            msg = 'WARNING in plotting.py / {}:'.format(funcname)
             msg += ' object does not contain expected key "type",'
             msg += ' will use default settings for color and label.'
             print(msg)
-        if label in labels: label = None
-        else: labels.append(label)
-        anchor = (patchxcoord-boxhalfwidth,patchycoord-boxhalfwidth)
-        box = mpl.patches.Rectangle(anchor, 2*boxhalfwidth, 2*boxhalfwidth,
-                                    edgecolor=color, facecolor=(0,0,0,0), 
-                                    label=label)
-        ax.add_patch(box)
-    # plot aesthetics
-    ax.legend()
-    # return the result
-    return (fig,ax)
+            warned = True
+        groups.setdefault((color, label), []).append(obj['coords'])
+    res = []
+    for (color, label), coords in groups.items():
+        coords = np.array(coords).reshape(-1, 2)
+        res.append((color, label, coords[:,1], coords[:,0]))
+    return res
+
+def _box_collection(xcoords, ycoords, boxhalfwidth, color='r', label=None):
+    ### make a single line collection with squares around many points
+    # note: mostly for internal use!
+    corners = np.array([(-1,-1), (1,-1), (1,1), (-1,1), (-1,-1)])*boxhalfwidth
+    centers = np.stack((xcoords, ycoords), axis=1)
+    segments = centers[:,np.newaxis,:] + corners[np.newaxis,:,:]
+    return mpl.collections.LineCollection(segments, colors=color, label=label)
 
 def reco_plot_default(image, objects):
     ### same as reco_plot but with some convenient default settings hard-coded.
@@ -72,11 +111,122 @@ def reco_plot_default(image, objects):
         'blob': 'g',
         'line': 'b'
       })
+    if isinstance(objects, np.ndarray): counts = clustertable.type_counts(objects)
+    else:
+        counts = {otype: 0 for otype in ['dot', 'blob', 'line']}
+        counts.update(collections.Counter([el['type'] for el in objects]))
     ldict = ({
-        'dot': 'Dot ({})'.format(len([el for el in objects if el['type']=='dot'])),
-        'blob': 'Blob ({})'.format(len([el for el in objects if el['type']=='blob'])),
-        'line': 'Line ({})'.format(len([el for el in objects if el['type']=='line']))
+        'dot': 'Dot ({})'.format(counts['dot']),
+        'blob': 'Blob ({})'.format(counts['blob']),
+        'line': 'Line ({})'.format(counts['line'])
       })
     boxhalfwidth = int(max(image.shape)/50)
     return reco_plot( image, objects=objects, cdict=cdict, ldict=ldict, 
-                      boxhalfwidth=boxhalfwidth )
\ No newline at end of file
+                      boxhalfwidth=boxhalfwidth )
+
+# default colors per object type for the rendering functions below
+DEFAULT_COLORS = {'dot': 'r', 'blob': 'g', 'line': 'b'}
+
+def render_rgb(image, objects=None, cdict=None, boxhalfwidth=5, scale=1,
+               vmin=None, vmax=None):
+    ### render an image with reconstructed objects directly into an RGB array
+    # same content as reco_plot, but without matplotlib figures,
+    # so it is fast and works without a display.
+    # input arguments:
+    # - image: 2D numpy array representing the image
+    # - objects: list of object dictionaries or cluster table (see reco_plot)
+    # - cdict: dictionary matching object types to matplotlib colors
+    #   (default: DEFAULT_COLORS)
+    # - boxhalfwidth: half width of each square (in image pixels)
+    # - scale: integer factor to enlarge the image with (for thinner boxes)
+    # - vmin, vmax: pixel values mapped to black and white
+    #   (default: minimum and maximum of the image)
+    # returns:
+    #   a numpy array of shape (height*scale, width*scale, 3) and type uint8
+    image = np.asarray(image, dtype=np.float64)
+    vmin = image.min() if vmin is None else vmin
+    vmax = image.max() if vmax is None else vmax
+    gray = np.clip((image-vmin)/max(vmax-vmin, 1e-12), 0, 1)
+    gray = (gray*255).astype(np.uint8)
+    if scale>1: gray = np.repeat(np.repeat(gray, scale, axis=0), scale, axis=1)
+    rgb = np.repeat(gray[:,:,np.newaxis], 3, axis=2)
+    if objects is None: return rgb
+    if cdict is None: cdict = DEFAULT_COLORS
+    # offsets of the pixels on the border of a square
+    halfwidth = int(round(boxhalfwidth*scale))
+    side = np.arange(-halfwidth, halfwidth+1)
+    offsets = np.concatenate((
+        np.stack((np.full(len(side), -halfwidth), side), axis=1),
+        np.stack((np.full(len(side), halfwidth), side), axis=1),
+        np.stack((side, np.full(len(side), -halfwidth)), axis=1),
+        np.stack((side, np.full(len(side), halfwidth)), axis=1)))
+    for (color, _, xcoords, ycoords) in _group_objects(objects, cdict, None, 'render_rgb'):
+        centers = np.stack((np.asarray(ycoords), np.asarray(xcoords)), axis=1)*scale + scale//2
+        pixels = (centers[:,np.newaxis,:] + offsets[np.newaxis,:,:]).reshape(-1, 2)
+        inside = ( (pixels[:,0]>=0) & (pixels[:,0]<rgb.shape[0])
+                   & (pixels[:,1]>=0) & (pixels[:,1]<rgb.shape[1]) )
+        pixels = pixels[inside]
+        rgb[pixels[:,0], pixels[:,1]] = np.round(np.array(mpl.colors.to_rgb(color))*255)
+    return rgb
+
+def _split_tables(table, nframes):
+    ### split a cluster table for many frames into one table per frame
+    # note: mostly for internal use!
+    order = np.argsort(table['frame'], kind='stable')
+    bounds = np.searchsorted(table['frame'][order], np.arange(1, nframes))
+    return np.split(table[order], bounds)
+
+def _render_frame(args):
+    ### render a single frame and optionally write it to a png file
+    # note: mostly for internal use! (runs in the worker processes)
+    # returns:
+    #   the RGB array if returnrgb is True, else None
+    #   (so it is only sent back to the parent process when needed)
+    (image, objects, path, returnrgb, kwargs) = args
+    rgb = render_rgb(image, objects=objects, **kwargs)
+    if path is not None: plt.imsave(path, rgb)
+    return rgb if returnrgb else None
+
+def export_frames(frames, objects=None, outdir=None, contactsheet=None, ncols=8,
+                  nworkers=None, chunksize=8, **kwargs):
+    ### render many frames with their reconstructed objects and write them to png files
+    # the frames are rendered with render_rgb in a pool of worker processes.
+    # input arguments:
+    # - frames: 3D numpy array of shape (height, width, nframes) (as in EVIFile)
+    #   or a list of 2D numpy arrays
+    # - objects: cluster table for all frames (with the frame field set to the frame index),
+    #   or a list with the objects of each frame (see reco_plot)
+    # - outdir: directory to write one png file per frame to (frame_<index>.png)
+    # - contactsheet: path to a png file showing all frames in a grid
+    # - ncols: number of columns in the contact sheet
+    # - nworkers: number of worker processes (default: number of cpus)
+    # - chunksize: number of frames per task sent to a worker
+    # - kwargs: passed down to render_rgb
+    # returns:
+    #   the contact sheet as an RGB array if contactsheet is specified, else None
+    if isinstance(frames, np.ndarray) and frames.ndim==3:
+        frames = [frames[:,:,i] for i in range(frames.shape[2])]
+    nframes = len(frames)
+    if objects is None: objects = [None]*nframes
+    elif isinstance(objects, np.ndarray): objects = _split_tables(objects, nframes)
+    if outdir is not None: os.makedirs(outdir, exist_ok=True)
+    paths = [os.path.join(outdir, 'frame_{:05d}.png'.format(i)) if outdir is not None else None
+             for i in range(nframes)]
+    returnrgb = (contactsheet is not None)
+    tasks = [(frames[i], objects[i], paths[i], returnrgb, kwargs) for i in range(nframes)]
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        rgbs = pool.map(_render_frame, tasks, chunksize=chunksize)
+        if contactsheet is None:
+            for _ in rgbs: pass
+            return None
+        sheet = None
+        for i,rgb in enumerate(rgbs):
+            if sheet is None:
+                nrows = -(-nframes//ncols)
+                (h, w) = rgb.shape[:2]
+                # frames are separated by a white line of one pixel
+                sheet = np.full((nrows*(h+1)-1, min(ncols, nframes)*(w+1)-1, 3), 255, dtype=np.uint8)
+            (row, col) = divmod(i, ncols)
+            sheet[row*(h+1):row*(h+1)+h, col*(w+1):col*(w+1)+w] = rgb
+    if sheet is not None: plt.imsave(contactsheet, sheet)
+    return sheet
@@ -1,65 +1,417 @@
 import numpy as np
+import labeling
 
 
-def max_diameter( cluster, method='full' ):
+# names of the cluster types, in order of their numeric codes
+TYPE_NAMES = ['dot', 'blob', 'line']
+TYPE_CODES = {name: code for code,name in enumerate(TYPE_NAMES)}
+# default diameter (in pixels) above which a cluster is considered a line
+LINE_DIAMETER = 4
+
+
+def _as_coords( cluster ):
+    ### convert a cluster to a 2D numpy array of coordinates
+    # note: mostly for internal use!
+    # input arguments:
+    # - cluster: list of coordinate tuples or numpy array of shape (npoints, 2)
+    # returns:
+    #   a numpy array of shape (npoints, 2)
+    coords = np.asarray(cluster)
+    return coords.reshape(-1, 2)
+
+def convex_hull( coords ):
+    ### get the convex hull of a set of integer points
+    # method: monotone chain, after keeping only the leftmost and rightmost
+    #         point in each row (the only candidates for hull vertices on a grid).
+    # input arguments:
+    # - coords: numpy array of shape (npoints, 2)
+    # returns:
+    #   a numpy array of shape (nvertices, 2) with the hull vertices
+    #   in counterclockwise order (without collinear points).
+    coords = np.asarray(coords, dtype=np.int64)
+    order = np.lexsort((coords[:,1], coords[:,0]))
+    coords = coords[order]
+    # keep the first and last point in each row
+    newrow = np.ones(len(coords), dtype=bool)
+    newrow[1:] = (coords[1:,0]!=coords[:-1,0])
+    lastinrow = np.ones(len(coords), dtype=bool)
+    lastinrow[:-1] = newrow[1:]
+    points = coords[newrow | lastinrow].tolist()
+    if len(points)<3: return np.array(points, dtype=np.int64).reshape(-1, 2)
+
+    def cross(o, a, b):
+        return (a[0]-o[0])*(b[1]-o[1]) - (a[1]-o[1])*(b[0]-o[0])
+
+    lower = []
+    for p in points:
+        while len(lower)>=2 and cross(lower[-2], lower[-1], p)<=0: lower.pop()
+        lower.append(p)
+    upper = []
+    for p in reversed(points):
+        while len(upper)>=2 and cross(upper[-2], upper[-1], p)<=0: upper.pop()
+        upper.append(p)
+    return np.array(lower[:-1]+upper[:-1], dtype=np.int64)
+
+def _rotating_calipers( hull ):
+    ### get the maximum squared distance between vertices of a convex polygon
+    # note: mostly for internal use!
+    # input arguments:
+    # - hull: numpy array of shape (nvertices, 2) in counterclockwise order
+    #   (e.g. the output of convex_hull)
+    # returns:
+    #   the maximum squared distance between any two vertices
+    n = len(hull)
+    if n==1: return 0
+    if n==2: return int(((hull[0]-hull[1])**2).sum())
+    hull = hull.tolist()
+
+    def area2(a, b, c):
+        return abs((b[0]-a[0])*(c[1]-a[1]) - (b[1]-a[1])*(c[0]-a[0]))
+
+    def dist2(a, b):
+        return (a[0]-b[0])**2 + (a[1]-b[1])**2
+
+    maxdist2 = 0
+    j = 1
+    for i in range(n):
+        inext = (i+1)%n
+        # advance the antipodal vertex while the distance to edge (i, inext) increases
+        while( area2(hull[i], hull[inext], hull[(j+1)%n])
+               > area2(hull[i], hull[inext], hull[j]) ):
+            j = (j+1)%n
+        maxdist2 = max(maxdist2, dist2(hull[i], hull[j]), dist2(hull[inext], hull[j]))
+    return maxdist2
+
+def max_diameter( cluster, method='auto' ):
     ### determine the maximum diameter of a cluster of points
     # help function for cluster_type (see below)
     # input arguments:
     # - cluster: list representing a point cluster;
     #   each element in the list is a tuple with point coordinates
-    
+    #   (a numpy array of shape (npoints, 2) is also accepted)
+    # - method: choose from the following options:
+    #   - 'full': calculate distances between all pairs of points
+    #     (memory and time scale quadratically with the number of points).
+    #   - 'hull': calculate distances between vertices of the convex hull only,
+    #     using rotating calipers.
+    #   - 'auto': use 'full' for small clusters and 'hull' for large clusters.
+    #   all methods give the same result.
+
+    coords = _as_coords(cluster)
+    if method=='auto':
+        method = 'full' if len(coords)<=64 else 'hull'
     if method=='full':
         # calculate distances between all points and get maximum
-        dists = []
-        for idx,point1 in enumerate(cluster):
-            for point2 in cluster[idx+1:]:
-                dist = (point1[0]-point2[0])**2 + (point1[1]-point2[1])**2
-                dist = np.sqrt(dist)
-                dists.append(dist)
-        dists = np.array(dists)
-        maxdist = np.amax(dists)
+        coords = coords.astype(float)
+        diffs = coords[:,np.newaxis,:] - coords[np.newaxis,:,:]
+        dists = np.sum(diffs**2, axis=-1)
+        maxdist = np.sqrt(np.amax(dists))
+        return maxdist
+    elif method=='hull':
+        hull = convex_hull(coords)
+        maxdist = np.sqrt(float(_rotating_calipers(hull)))
         return maxdist
     else:
         msg = 'ERROR in reco.py / max_diameter:'
         msg += 'method "{}" not recognized.'.format(method)
         raise Exception(msg)
-        
+
 def center( cluster, method='full' ):
     ### get the center of a cluster
+    # the center is defined as the point for which the sum of squared distances
+    # to all other points is minimal (the first one in case of ties).
     # input arguments:
     # - cluster: list representing a point cluster;
     #   each element in the list is a tuple with point coordinates
-    
+    #   (a numpy array of shape (npoints, 2) is also accepted)
+    # returns:
+    #   the central point (an element of cluster if it is a list,
+    #   else a tuple of coordinates)
+
     if method=='full':
-        # calculate (squared) distances from each point to all other points
-        # and take the point for which the sum is minimal
-        idx = 0
-        minsumdists = 1e6
-        for i,point1 in enumerate(cluster):
-            sumdists = 0
-            for point2 in cluster:
-                dist = (point1[0]-point2[0])**2 + (point1[1]-point2[1])**2
-                sumdists += dist
-            if sumdists < minsumdists:
-                minsumdists = sumdists
-                idx = i
+        # the sum of squared distances from point i to all points
+        # equals npoints * |p_i - centroid|^2 + constant,
+        # so take the point closest to the centroid.
+        # note: use npoints * p_i - sum(p) to keep exact integer arithmetic.
+        coords = _as_coords(cluster)
+        diffs = len(coords)*coords - np.sum(coords, axis=0)
+        idx = int(np.argmin(np.sum(diffs**2, axis=1)))
+        if isinstance(cluster, np.ndarray): return tuple(cluster[idx].tolist())
         return cluster[idx]
     else:
         msg = 'ERROR in reco.py / center:'
         msg += 'method "{}" not recognized.'.format(method)
         raise Exception(msg)
 
-def cluster_type( cluster ):
+def centers( rows, cols, labels, nclusters ):
+    ### get the centers of many clusters at once
+    # vectorized version of center (see above) for a labeled list of hits.
+    # input arguments:
+    # - rows, cols: 1D numpy arrays with the coordinates of the hits,
+    #   in row-major order within each cluster
+    # - labels: 1D numpy array with a cluster index for each hit
+    # - nclusters: number of clusters
+    #   (e.g. the output of labeling.label_hits)
+    # returns:
+    #   a 1D numpy array with for each cluster the index of its central hit.
+    #   in case of ties, the hit that comes first in the order in which
+    #   counting.count_objects_cluster with method 'iterative' grows the cluster
+    #   is taken (see labeling.growth_passes), so the result is the same
+    #   as applying center to the clusters of that method.
+    if nclusters==0: return np.zeros(0, dtype=np.int64)
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    npixels = np.bincount(labels, minlength=nclusters)
+    sumrows = np.bincount(labels, weights=rows, minlength=nclusters).astype(np.int64)
+    sumcols = np.bincount(labels, weights=cols, minlength=nclusters).astype(np.int64)
+    dists = ( (npixels[labels]*rows - sumrows[labels])**2
+              + (npixels[labels]*cols - sumcols[labels])**2 )
+    # sort by cluster, then by distance, then by hit index and take the first per cluster
+    order = np.lexsort((np.arange(len(rows)), dists, labels))
+    starts = np.concatenate(([0], np.cumsum(npixels)[:-1]))
+    res = order[starts]
+    # resolve ties using the growth order of the iterative clustering
+    # (only for the clusters where it matters, as it is more expensive)
+    mindists = dists[res]
+    seconds = order[np.minimum(starts+1, len(order)-1)]
+    tied = (npixels>1) & (dists[seconds]==mindists) & (labels[seconds]==np.arange(nclusters))
+    if np.any(tied):
+        sel = np.nonzero(tied[labels])[0]
+        passes = labeling.growth_passes(rows[sel], cols[sel], labels[sel])
+        candidates = (dists[sel]==mindists[labels[sel]])
+        (sel, passes) = (sel[candidates], passes[candidates])
+        selorder = np.lexsort((sel, passes, labels[sel]))
+        (sel, sellabels) = (sel[selorder], labels[sel][selorder])
+        firsts = np.unique(sellabels, return_index=True)[1]
+        res[sellabels[firsts]] = sel[firsts]
+    return res
+
+def max_diameters( rows, cols, labels, nclusters, maxpairs=1000000 ):
+    ### get the maximum diameters of many clusters at once
+    # vectorized version of max_diameter (see above) for a labeled list of hits.
+    # method: the extents of the bounding box of a cluster give a lower bound
+    #         (the largest extent) and an upper bound (the diagonal) on its diameter;
+    #         both are equal for clusters with a single row or column (e.g. single pixels),
+    #         so only the other clusters need the exact calculation.
+    #         for those with at most 64 pixels, the distances between all pairs of hits
+    #         are calculated at once (in chunks of at most maxpairs pairs),
+    #         the few larger ones are done one by one with the convex hull.
+    # input arguments:
+    # - rows, cols: 1D numpy arrays with the coordinates of the hits
+    # - labels: 1D numpy array with a cluster index for each hit
+    # - nclusters: number of clusters
+    #   (e.g. the output of labeling.label_hits)
+    # - maxpairs: maximum number of pairs of hits to process at once (limits the memory use)
+    # returns:
+    #   a 1D numpy array with the maximum diameter of each cluster
+    #   (the same as max_diameter for each cluster).
+    diameters = np.zeros(nclusters)
+    if nclusters==0: return diameters
+    npixels = np.bincount(labels, minlength=nclusters)
+    order = np.argsort(labels, kind='stable')
+    starts = np.concatenate(([0], np.cumsum(npixels)[:-1]))
+    srows = np.asarray(rows, dtype=np.int64)[order]
+    scols = np.asarray(cols, dtype=np.int64)[order]
+    def extent(x): return np.maximum.reduceat(x, starts) - np.minimum.reduceat(x, starts)
+    (rowextents, colextents) = (extent(srows), extent(scols))
+    diameters[:] = np.maximum(rowextents, colextents)
+    # exact calculation for the clusters where the bounds differ
+    todo = (rowextents>0) & (colextents>0)
+    small = np.nonzero(todo & (npixels<=64))[0]
+    npairs = npixels[small]**2
+    cumpairs = np.cumsum(npairs)
+    start = 0
+    while start<len(small):
+        stop = max(np.searchsorted(cumpairs, cumpairs[start]-npairs[start]+maxpairs, side='right'),
+                   start+1)
+        (chunk, n, p) = (small[start:stop], npixels[small[start:stop]], npairs[start:stop])
+        pairstarts = np.concatenate(([0], np.cumsum(p)[:-1]))
+        k = np.arange(np.sum(p)) - np.repeat(pairstarts, p)
+        first = np.repeat(starts[chunk], p) + k//np.repeat(n, p)
+        second = np.repeat(starts[chunk], p) + k%np.repeat(n, p)
+        dists = (srows[first]-srows[second])**2 + (scols[first]-scols[second])**2
+        diameters[chunk] = np.sqrt(np.maximum.reduceat(dists, pairstarts).astype(float))
+        start = stop
+    for i in np.nonzero(todo & (npixels>64))[0]:
+        coords = np.stack((srows[starts[i]:starts[i]+npixels[i]],
+                           scols[starts[i]:starts[i]+npixels[i]]), axis=1)
+        diameters[i] = max_diameter(coords, method='hull')
+    return diameters
+
+def energy_stats( rows, cols, values, labels, nclusters ):
+    ### get the energy-related properties of many clusters at once
+    # method: one pass over the hits with bincount for the sums,
+    #         and a single reduceat over the hits sorted by cluster for the maxima.
+    # input arguments:
+    # - rows, cols: 1D numpy arrays with the coordinates of the hits
+    # - values: 1D numpy array with the pixel value (energy) of each hit
+    # - labels: 1D numpy array with a cluster index for each hit
+    # - nclusters: number of clusters
+    #   (e.g. the output of labeling.label_hits)
+    # returns:
+    #   a tuple (energies, rowcentroids, colcentroids, maxvalues) of 1D numpy arrays
+    #   with for each cluster the sum of the pixel values, the energy-weighted
+    #   centroid (unweighted for clusters with zero total energy)
+    #   and the maximum pixel value.
+    if nclusters==0:
+        return tuple([np.zeros(0) for i in range(4)])
+    values = np.asarray(values, dtype=np.float64)
+    npixels = np.bincount(labels, minlength=nclusters)
+    energies = np.bincount(labels, weights=values, minlength=nclusters)
+    sumrows = np.bincount(labels, weights=rows*values, minlength=nclusters)
+    sumcols = np.bincount(labels, weights=cols*values, minlength=nclusters)
+    # fall back to the unweighted centroid for clusters without energy
+    noenergy = (energies==0)
+    if np.any(noenergy):
+        energies_safe = np.where(noenergy, npixels, energies)
+        sumrows = np.where(noenergy, np.bincount(labels, weights=rows, minlength=nclusters), sumrows)
+        sumcols = np.where(noenergy, np.bincount(labels, weights=cols, minlength=nclusters), sumcols)
+    else: energies_safe = energies
+    order = np.argsort(labels, kind='stable')
+    starts = np.concatenate(([0], np.cumsum(npixels)[:-1]))
+    maxvalues = np.maximum.reduceat(values[order], starts)
+    return (energies, sumrows/energies_safe, sumcols/energies_safe, maxvalues)
+
+def track_stats( rows, cols, labels, nclusters ):
+    ### get the shape of many clusters at once, e.g. for reconstructing tracks
+    # method: all quantities follow from per-cluster sums (computed with bincount)
+    #         of the hit coordinates relative to the cluster centroid:
+    #         - the principal axis is the eigenvector of the coordinate covariance matrix
+    #           with the largest eigenvalue;
+    #         - length and width are the extent of the cluster (in pixels)
+    #           along the principal axis and perpendicular to it;
+    #         - the curvature follows from a least-squares fit of a parabola
+    #           to the hits in the frame of the principal axis (a linear problem),
+    #           as the inverse radius of the circle through its ends and vertex;
+    #           unlike a direct circle fit, this is not biased towards
+    #           large curvatures for short or (rasterized) straight tracks.
+    # input arguments:
+    # - rows, cols: 1D numpy arrays with the coordinates of the hits
+    # - labels: 1D numpy array with a cluster index for each hit
+    # - nclusters: number of clusters
+    #   (e.g. the output of labeling.label_hits)
+    # returns:
+    #   a tuple (angles, lengths, widths, curvatures) of 1D numpy arrays
+    #   with for each cluster:
+    #   - the angle of the principal axis with the column axis in radians,
+    #     between -pi/2 and pi/2 (with rows pointing down, as in an image)
+    #   - the length and width in pixels (1 for a single pixel)
+    #   - the curvature in 1/pixels (0 for clusters with less than 3 pixels
+    #     or less than 3 distinct positions along the principal axis,
+    #     and close to 0 for clusters on a straight line)
+    angles = np.zeros(nclusters)
+    lengths = np.ones(nclusters)
+    widths = np.ones(nclusters)
+    curvatures = np.zeros(nclusters)
+    if nclusters==0: return (angles, lengths, widths, curvatures)
+    # only clusters with more than one pixel need to be processed
+    npixels = np.bincount(labels, minlength=nclusters)
+    multi = np.nonzero(npixels>1)[0]
+    if len(multi)==0: return (angles, lengths, widths, curvatures)
+    (res_angles, res_lengths, res_widths, res_curvatures) = _track_stats_multi(
+        rows, cols, labels, nclusters, npixels, multi)
+    angles[multi] = res_angles
+    lengths[multi] = res_lengths
+    widths[multi] = res_widths
+    curvatures[multi] = res_curvatures
+    return (angles, lengths, widths, curvatures)
+
+def _track_stats_multi( rows, cols, labels, nclusters, npixels, multi ):
+    ### see track_stats, for the clusters with indices multi only
+    # note: mostly for internal use!
+    # relabel the selected clusters consecutively and drop the other hits
+    newlabels = np.full(nclusters, -1)
+    newlabels[multi] = np.arange(len(multi))
+    labels = newlabels[labels]
+    keep = (labels>=0)
+    labels = labels[keep]
+    rows = np.asarray(rows, dtype=np.float64)[keep]
+    cols = np.asarray(cols, dtype=np.float64)[keep]
+    nclusters = len(multi)
+    npixels = npixels[multi]
+    # coordinates relative to the centroid
+    u = cols - (np.bincount(labels, weights=cols, minlength=nclusters)/npixels)[labels]
+    v = rows - (np.bincount(labels, weights=rows, minlength=nclusters)/npixels)[labels]
+    def moment(weights): return np.bincount(labels, weights=weights, minlength=nclusters)
+    (uu, vv, uv) = (u*u, v*v, u*v)
+    (suu, svv, suv) = (moment(uu), moment(vv), moment(uv))
+    # principal axis from the covariance matrix [[suu, suv], [suv, svv]]
+    angles = 0.5*np.arctan2(2*suv, suu-svv)
+    # extent along and perpendicular to the principal axis
+    (cosa, sina) = (np.cos(angles), np.sin(angles))
+    along = u*cosa[labels] + v*sina[labels]
+    across = -u*sina[labels] + v*cosa[labels]
+    order = np.argsort(labels, kind='stable')
+    starts = np.concatenate(([0], np.cumsum(npixels)[:-1]))
+    def extent(x): return np.maximum.reduceat(x[order], starts) - np.minimum.reduceat(x[order], starts)
+    lengths = extent(along)+1
+    widths = extent(across)+1
+    # quadratic fit across = a + b*along + c*along^2 in the principal-axis frame,
+    # a linear least-squares problem in (a, b, c);
+    # the along coordinate is scaled to unit rms for a well-conditioned system.
+    scale = np.sqrt(np.maximum(moment(along*along)/npixels, 1e-12))
+    t = along/scale[labels]
+    t2 = t*t
+    matrix = np.empty((nclusters, 3, 3))
+    matrix[:,0,0] = npixels
+    matrix[:,0,1] = matrix[:,1,0] = moment(t)
+    matrix[:,0,2] = matrix[:,2,0] = matrix[:,1,1] = moment(t2)
+    matrix[:,1,2] = matrix[:,2,1] = moment(t2*t)
+    matrix[:,2,2] = moment(t2*t2)
+    rhs = np.stack((moment(across), moment(t*across), moment(t2*across)), axis=1)
+    # less than three distinct positions along the axis give a singular system
+    valid = (npixels>=3) & (np.abs(np.linalg.det(matrix)) > 1e-9*npixels**3)
+    curvatures = np.zeros(nclusters)
+    if np.any(valid):
+        coefs = np.linalg.solve(matrix[valid], rhs[valid][:,:,np.newaxis])[:,:,0]
+        quads = coefs[:,2]/scale[valid]**2
+        # radius of the circle through the ends and the vertex of the fitted parabola,
+        # from the half chord h and the sagitta s = |c|*h^2: R = (h^2+s^2)/(2s)
+        halfchords = (lengths[valid]-1)/2
+        sagittas = np.abs(quads)*halfchords**2
+        curvatures[valid] = 2*sagittas/(halfchords**2+sagittas**2)
+    return (angles, lengths, widths, curvatures)
+
+def cluster_type( cluster, linediameter=LINE_DIAMETER, energy=None, dotenergy=None ):
     ### get the type of a cluster
     # input arguments:
     # - cluster: list representing a point cluster;
     #   each element in the list is a tuple with point coordinates
+    # - linediameter: diameter above which a cluster is considered a line
+    # - energy: total energy (sum of pixel values) of the cluster
+    # - dotenergy: if specified (together with energy), clusters with a total energy
+    #   of at most dotenergy are considered dots, regardless of their size
+    #   (e.g. a low-energy hit shared over neighbouring pixels).
     # returns:
     #   a string representing the cluster type;
     #   see below for options and definitions.
-    
+
     if len(cluster)==1:
         return 'dot'
+    if energy is not None and dotenergy is not None and energy<=dotenergy:
+        return 'dot'
     maxd = max_diameter(cluster)
-    if maxd>4: return 'line'
-    else: return 'blob'
\ No newline at end of file
+    if maxd>linediameter: return 'line'
+    else: return 'blob'
+
+def cluster_type_codes( npixels, diameters, linediameter=LINE_DIAMETER,
+                        energies=None, dotenergy=None ):
+    ### get the types of many clusters at once
+    # vectorized version of cluster_type (see above).
+    # input arguments:
+    # - npixels: 1D numpy array with the number of pixels in each cluster
+    # - diameters: 1D numpy array with the maximum diameter of each cluster
+    # - linediameter: diameter above which a cluster is considered a line
+    # - energies: 1D numpy array with the total energy of each cluster
+    # - dotenergy: see cluster_type
+    # returns:
+    #   a 1D numpy array with the type code of each cluster
+    #   (see TYPE_NAMES for the corresponding names)
+    npixels = np.asarray(npixels)
+    diameters = np.asarray(diameters)
+    codes = np.full(len(npixels), TYPE_CODES['blob'], dtype=np.int8)
+    codes[diameters>linediameter] = TYPE_CODES['line']
+    codes[npixels==1] = TYPE_CODES['dot']
+    if energies is not None and dotenergy is not None:
+        codes[np.asarray(energies)<=dotenergy] = TYPE_CODES['dot']
+    return codes
@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import hashlib
+import numpy as np
+import reco
+import counting
+import clustertable
+
+# internal modules in other directories
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../reading'))
+import EVIFile
+
+
+# version of the cached results; increase it when a change in the reconstruction
+# changes its output, so that results of older versions are not used anymore.
+# (changes in the layout of the cluster table are detected automatically.)
+CACHE_VERSION = 2
+
+
+class ResultCache():
+    ### class for caching reconstruction results on disk
+    # each result is stored as a compressed .npz file holding a cluster table
+    # (see clustertable.py), keyed by the input file and the reconstruction parameters.
+    # the key also includes the layout of the cluster table (clustertable.cluster_dtype)
+    # and the cache version (CACHE_VERSION), so results of another code version are not used.
+    # the input file is identified by its path, size and modification time,
+    # or optionally by a hash of its content (slower, but robust against copies and touches).
+    # when the total size of the cache exceeds a maximum,
+    # the least recently used results are removed.
+    # usage:
+    #   cache = ResultCache('reco_cache', maxbytes=1e9)
+    #   table = cache.get_or_compute(filename, params, lambda: <reconstruct filename>)
+
+    def __init__(self, cachedir, maxbytes=1e9, contenthash=False):
+        ### initializer
+        # input arguments:
+        # - cachedir: directory where the results are stored
+        # - maxbytes: maximum total size of the cache in bytes
+        # - contenthash: identify input files by a hash of their content
+        #   instead of their path, size and modification time
+        self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        self.contenthash = contenthash
+        os.makedirs(cachedir, exist_ok=True)
+
+    def key(self, filename, params):
+        ### make the cache key for a given input file and parameters
+        # input arguments:
+        # - filename: path to the input file
+        # - params: dictionary of reconstruction parameters (json-serializable)
+        if self.contenthash:
+            sha = hashlib.sha1()
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1<<20), b''): sha.update(block)
+            fileid = {'content': sha.hexdigest()}
+        else:
+            stat = os.stat(filename)
+            fileid = {'file': os.path.abspath(filename),
+                      'size': stat.st_size, 'mtime': stat.st_mtime}
+        keystr = json.dumps({'input': fileid, 'params': params, 'version': CACHE_VERSION,
+                             'schema': clustertable.cluster_dtype.descr}, sort_keys=True)
+        return hashlib.sha1(keystr.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        ### return the path of the cache file for a given key
+        # note: mostly for internal use!
+        return os.path.join(self.cachedir, 'reco_{}.npz'.format(key))
+
+    def get(self, filename, params):
+        ### get a cached result
+        # returns:
+        #   the cluster table, or None if no result is cached for this input
+        path = self._path(self.key(filename, params))
+        if not os.path.exists(path): return None
+        try:
+            with np.load(path) as f: table = f['table']
+        except Exception:
+            # corrupt or partially written file: treat as missing
+            return None
+        # mark as recently used
+        os.utime(path)
+        return table
+
+    def put(self, filename, params, table):
+        ### store a result in the cache and evict old results if needed
+        path = self._path(self.key(filename, params))
+        # write to a temporary file first, so an interrupted write does not leave a broken entry
+        tmppath = path+'.tmp.npz'
+        np.savez_compressed(tmppath, table=table,
+                            params=json.dumps(params, sort_keys=True),
+                            filename=os.path.abspath(filename))
+        os.replace(tmppath, path)
+        self.evict()
+
+    def get_or_compute(self, filename, params, func):
+        ### get a cached result, or compute and store it if it is not cached
+        # input arguments:
+        # - filename, params: see key
+        # - func: function without arguments returning the cluster table
+        table = self.get(filename, params)
+        if table is None:
+            table = func()
+            self.put(filename, params, table)
+        return table
+
+    def size(self):
+        ### return the total size of the cache in bytes
+        return sum([os.path.getsize(path) for path in self._entries()])
+
+    def _entries(self):
+        ### return the paths of all cache files
+        # note: mostly for internal use!
+        return [os.path.join(self.cachedir, f) for f in os.listdir(self.cachedir)
+                if f.startswith('reco_') and f.endswith('.npz') and not f.endswith('.tmp.npz')]
+
+    def evict(self):
+        ### remove the least recently used results until the cache fits in maxbytes
+        entries = [(os.path.getmtime(path), os.path.getsize(path), path) for path in self._entries()]
+        total = sum([entry[1] for entry in entries])
+        for (_, size, path) in sorted(entries):
+            if total<=self.maxbytes: break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        ### remove all results from the cache
+        for path in self._entries(): os.remove(path)
+
+
+def reco_file( filename, cache=None, linediameter=reco.LINE_DIAMETER, dotenergy=None, chunk=64 ):
+    ### reconstruct all frames in an EVI file, using a result cache if provided
+    # input arguments:
+    # - filename: path to the EVI file
+    # - cache: ResultCache object (default: no caching)
+    # - linediameter, dotenergy: see reco.cluster_type
+    # - chunk: number of frames to read at once
+    # returns:
+    #   a cluster table for all frames in the file (see clustertable.py)
+
+    def func():
+        evi = EVIFile.EVIFile(filename, mode='header')
+        return counting.reco_hits(evi.get_hits(chunk=chunk), linediameter=linediameter,
+                                  dotenergy=dotenergy)
+
+    if cache is None: return func()
+    params = {'method': 'reco_hits', 'linediameter': linediameter, 'dotenergy': dotenergy}
+    return cache.get_or_compute(filename, params, func)
@@ -0,0 +1,163 @@
+import os
+import sys
+import glob
+import time
+import queue
+import threading
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import reco
+import counting
+import masking
+import clustertable
+
+# internal modules in other directories
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../reading'))
+import EVIFile
+
+
+def _reco_hits( hits, frameoffset, linediameter ):
+    ### reconstruct the clusters in a hit list and shift the frame indices
+    # note: mostly for internal use! (runs in the worker processes)
+    table = counting.reco_hits(hits, linediameter=linediameter)
+    table['frame'] += frameoffset
+    return table
+
+def _put( results, item, stopped ):
+    ### put an item in a bounded queue, unless the driver has stopped
+    # note: mostly for internal use!
+    while not stopped.is_set():
+        try:
+            results.put(item, timeout=0.1)
+            return
+        except queue.Full: pass
+
+def _read_files( filenames, tasks, results, chunk, mask, stopped ):
+    ### read files and put their hit lists in a queue
+    # note: mostly for internal use! (runs in the reader threads)
+    # input arguments:
+    # - filenames: list of all file names
+    # - tasks: queue with the indices of the files to read
+    # - results: bounded queue to put tuples (file index, hit list, read time) in;
+    #   blocks when the reconstruction falls behind.
+    # - chunk: number of frames to read at once
+    # - mask: hot pixel mask to apply (or None)
+    # - stopped: event signaling that the driver has stopped
+    try:
+        while not stopped.is_set():
+            try: i = tasks.get_nowait()
+            except queue.Empty: break
+            starttime = time.perf_counter()
+            evi = EVIFile.EVIFile(filenames[i], mode='header')
+            hits = evi.get_hits(chunk=chunk)
+            if mask is not None: hits = masking.apply_mask(hits, mask)
+            readtime = time.perf_counter()-starttime
+            _put(results, (i, hits, readtime), stopped)
+    except Exception as e: _put(results, (None, e, 0.), stopped)
+    finally: _put(results, None, stopped)
+
+def reco_run( files, outfile=None, nworkers=None, nreaders=2, maxqueue=2,
+              framesperjob=256, chunk=64, linediameter=reco.LINE_DIAMETER,
+              mask=None, verbose=False ):
+    ### reconstruct all frames in a run consisting of many EVI files
+    # method: reader threads read the files (in the background) into hit lists,
+    #         while worker processes reconstruct the hits of files read before.
+    #         the number of files waiting to be reconstructed (maxqueue)
+    #         and the number of jobs waiting for a worker are bounded,
+    #         so memory use does not grow when reading is faster than reconstruction.
+    # input arguments:
+    # - files: glob pattern (e.g. 'run1/*.EVI') or list of file names
+    # - outfile: path to an .npz file to write the merged cluster table to (optional)
+    # - nworkers: number of worker processes for the reconstruction (default: number of cpus)
+    # - nreaders: number of reader threads
+    # - maxqueue: maximum number of read files waiting to be reconstructed
+    # - framesperjob: number of frames per job sent to a worker
+    # - chunk: number of frames to read at once (see EVIFile.iter_frames)
+    # - linediameter: see reco.cluster_type
+    # - mask: hot pixel mask applied to all files (see masking.py)
+    # - verbose: print progress after each file
+    # returns:
+    #   a tuple (table, report) with:
+    #   - table: cluster table for the whole run (see clustertable.py),
+    #     with the frame field holding the frame index within the run,
+    #     i.e. counting through the files in order.
+    #   - report: dictionary with the files (see EVIFile.scan) and their first frame index
+    #     in the run, the number of frames and clusters, the wall time and
+    #     the sustained number of frames per second.
+    if isinstance(files, str): files = sorted(glob.glob(files))
+    if len(files)==0:
+        msg = 'ERROR in rundriver.py / reco_run: no files found.'
+        raise Exception(msg)
+    nworkers = nworkers if nworkers is not None else os.cpu_count()
+    starttime = time.perf_counter()
+    # scan the headers to assign run-level frame indices to each file
+    catalogue = EVIFile.scan_files(files)
+    for entry in catalogue:
+        if 'error' in entry:
+            msg = 'ERROR in rundriver.py / reco_run: could not read header of {}: {}'.format(
+                  entry['filename'], entry['error'])
+            raise Exception(msg)
+    nframes = np.array([min(entry['nimages'], entry['nimages_on_disk']) for entry in catalogue])
+    offsets = np.concatenate(([0], np.cumsum(nframes)[:-1])).astype(int)
+    # start the reader threads
+    tasks = queue.Queue()
+    for i in range(len(files)): tasks.put(i)
+    results = queue.Queue(maxsize=maxqueue)
+    stopped = threading.Event()
+    readers = [threading.Thread(target=_read_files, daemon=True,
+                                args=(files, tasks, results, chunk, mask, stopped))
+               for _ in range(nreaders)]
+    for reader in readers: reader.start()
+    # reconstruct the hits of each file as it comes in
+    tables = {}
+    readtime = 0.
+    nfinished = 0
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+        maxpending = 2*nworkers
+        pending = {}
+        def collect(block):
+            # collect finished jobs; if block is True, wait for at least one
+            done = [future for future in pending if future.done()]
+            if block and len(done)==0:
+                done = wait(list(pending), return_when=FIRST_COMPLETED)[0]
+            for future in done: tables[pending.pop(future)] = future.result()
+        try:
+            while nfinished<nreaders:
+                item = results.get()
+                if item is None:
+                    nfinished += 1
+                    continue
+                (i, hits, filereadtime) = item
+                if i is None: raise hits
+                readtime += filereadtime
+                nfileframes = min(hits.nframes, nframes[i])
+                for start in range(0, nfileframes, framesperjob):
+                    end = min(start+framesperjob, nfileframes)
+                    while len(pending)>=maxpending: collect(True)
+                    future = pool.submit(_reco_hits, hits.select(start, end),
+                                         offsets[i]+start, linediameter)
+                    pending[future] = (i, start)
+                collect(False)
+                if verbose:
+                    print('read file {} ({} frames, {:.2f} s)'.format(files[i], nfileframes, filereadtime))
+            while len(pending)>0: collect(True)
+        finally:
+            stopped.set()
+            for reader in readers: reader.join()
+    # merge the tables in run order
+    table = clustertable.concatenate([tables[key] for key in sorted(tables.keys())])
+    walltime = time.perf_counter()-starttime
+    report = {'files': catalogue, 'frameoffsets': offsets.tolist(),
+              'nframes': int(np.sum(nframes)), 'nclusters': len(table),
+              'time': walltime, 'readtime': readtime,
+              'fps': float(np.sum(nframes))/walltime if walltime>0 else None}
+    if outfile is not None:
+        # write to a temporary file first, so an interrupted write does not leave a broken output
+        tmpfile = outfile+'.tmp.npz'
+        np.savez_compressed(tmpfile, table=table, files=np.array(files),
+                            frameoffsets=offsets, nframes=nframes)
+        os.replace(tmpfile, outfile)
+    if verbose:
+        print('reconstructed {} frames from {} files in {:.2f} s ({:.1f} frames per second)'.format(
+              report['nframes'], len(files), walltime, report['fps']))
+    return (table, report)